@@ -1,122 +1,86 @@
-import pandas as pd
-import numpy as np
-import json
-from utils import load_data
+import argparse
+import os
+from utils import load_data, iter_combined, combined_columns, domain_fields, DATA_DIR
+import profiling
+from validation import validate, validate_chunks, validate_parallel, format_results, summarize_results, write_results
 
-# Load the data and data dictionary
-df, data_dictionary = load_data()
+parser = argparse.ArgumentParser(description='Validate the combined dataset against the data dictionary')
+parser.add_argument('--fields', nargs='+', help='validate only these fields (checkboxes include their exploded columns)')
+parser.add_argument('--domains', nargs='+', help='validate only the fields of these domain_map domains')
+parser.add_argument('--cohorts', nargs='+', help='validate only rows of these cohorts (survey values)')
+parser.add_argument('--output', default=os.path.join(DATA_DIR, 'validation'),
+                    help='write results to OUTPUT.json (and OUTPUT.parquet with pyarrow)')
+parser.add_argument('--chunksize', type=int,
+                    help='validate in chunks of this many rows instead of loading the whole dataset')
+parser.add_argument('--workers', type=int, default=1,
+                    help='validate column groups in this many processes, each reading only its own columns')
+parser.add_argument('--strict', action='store_true', help='exit with status 1 when any rule fails')
+parser.add_argument('--profile', action='store_true',
+                    help='time the load and every rule and write a summary and Chrome trace to data/profile')
 
-def check_data_types(df, data_dictionary):
-    inconsistencies = []
-    for column in df.columns:
-        if column in data_dictionary:
-            expected_type = data_dictionary[column]['type']
-            actual_type = df[column].dtype
-            if not type_matches(expected_type, actual_type):
-                inconsistencies.append(f"Column '{column}': Expected {expected_type}, got {actual_type}")
-    return inconsistencies
+# Validate the combined dataset and write the results. data is an optional
+# (DataFrame, data dictionary) pair of the full typed dataset, as returned by
+# load_data(). Returns the results table.
+def main(argv=None, data=None):
+    # parse_known_args keeps this runnable from Jupyter, which passes its own arguments
+    args, _ = parser.parse_known_args(argv)
+    if args.profile:
+        profiling.enable('validate')
 
-def type_matches(expected_type, actual_type):
-    if expected_type in ['radio', 'dropdown', 'checkbox', 'checkbox_option']:
-        return isinstance(actual_type, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(actual_type)
-    elif expected_type == 'text':
-        return pd.api.types.is_string_dtype(actual_type)
-    elif expected_type in ['number', 'calc']:
-        return pd.api.types.is_numeric_dtype(actual_type)
-    elif expected_type == 'yesno':
-        return pd.api.types.is_bool_dtype(actual_type)
-    elif expected_type == 'date_ymd':
-        return pd.api.types.is_datetime64_any_dtype(actual_type)
-    return True  # Default to True for unknown types
+    # Load the data and data dictionary, reading only the requested columns and rows.
+    # With --chunksize the data is streamed and only one chunk is held at a time;
+    # with --workers each worker process reads its own columns. A full dataset
+    # already loaded by the caller (see pipeline.py) is used as-is.
+    if data is not None and not (args.workers > 1 or args.chunksize or args.fields or args.domains or args.cohorts):
+        df, data_dictionary = data
+    elif args.workers > 1:
+        columns, data_dictionary = combined_columns(columns=args.fields, domains=args.domains)
+    elif args.chunksize:
+        chunks, columns, data_dictionary = iter_combined(args.chunksize, columns=args.fields,
+                                                         domains=args.domains, cohorts=args.cohorts)
+    else:
+        with profiling.span('load data'):
+            df, data_dictionary = load_data(columns=args.fields, domains=args.domains, cohorts=args.cohorts)
+    # The record ID is the dictionary's first field, whatever is selected below
+    record_id = next(iter(data_dictionary))
+    if args.fields or args.domains:
+        selected = set(args.fields or []) | set(domain_fields(args.domains or []))
+        data_dictionary = {field: info for field, info in data_dictionary.items() if field in selected}
 
-def check_value_ranges(df, data_dictionary):
-    inconsistencies = []
-    for column, info in data_dictionary.items():
-        if column in df.columns and info['type'] in ['radio', 'dropdown']:
-            valid_values = set(int(key) for key in info['value_labels'].keys() if info['value_labels'])
-            actual_values = set(df[column].dropna().unique())
-            
-            # Convert float values to int if they're whole numbers
-            actual_values = {int(val) if isinstance(val, float) and val.is_integer() else val for val in actual_values}
-            
-            invalid_values = actual_values - valid_values
-            if invalid_values:
-                inconsistencies.append(f"Column '{column}': Invalid values found: {invalid_values}")
-    return inconsistencies
+    # Compile the dictionary into rules and evaluate them against the data
+    if args.workers > 1:
+        results = validate_parallel(data_dictionary, columns, args.workers, cohorts=args.cohorts,
+                                    chunksize=args.chunksize, record_id=record_id)
+    elif args.chunksize:
+        results = validate_chunks(chunks, columns, data_dictionary, record_id)
+    else:
+        results = validate(df, data_dictionary, record_id)
 
-def check_checkbox_consistency(df, data_dictionary):
-    inconsistencies = []
-    for column, info in data_dictionary.items():
-        if info.get('type') == 'checkbox':
-            expected_fields = [f"{column}___{key}" for key in info.get('value_labels', {}).keys()]
-            actual_fields = [col for col in df.columns if col.startswith(f"{column}___")]
-            
-            unexpected_fields = set(actual_fields) - set(expected_fields)
-            if unexpected_fields:
-                inconsistencies.append(f"Checkbox field '{column}' has unexpected exploded fields: {unexpected_fields}")
-            
-            for field in actual_fields:
-                if not pd.api.types.is_bool_dtype(df[field]):
-                    inconsistencies.append(f"Exploded checkbox field '{field}' is not boolean type")
-    
-    return inconsistencies
+    # Print results
+    for section, lines in format_results(results, data_dictionary).items():
+        if lines:
+            print(f"\n{section}:")
+            for line in lines:
+                print(f"- {line}")
+        else:
+            print(f"\n{section}: None")
 
-def check_missing_columns(df, data_dictionary):
-    missing_columns = []
-    for column, info in data_dictionary.items():
-        if info.get('exploding'):  # Check for non-standard exploding first
-            if 'exploded_fields' in info:
-                expected_columns = info['exploded_fields']
-                missing = [col for col in expected_columns if col not in df.columns]
-                if missing:
-                    missing_columns.append(f"Non-standard exploding field '{column}' is missing exploded fields: {missing}")
-            else:
-                print(f"Warning: {column} is marked as exploding but does not have 'exploded_fields' defined in the data dictionary.")
-        elif info.get('is_checkbox'):  # Then check for standard checkboxes
-            if 'exploded_fields' in info:
-                expected_columns = info['exploded_fields']
-                missing = [col for col in expected_columns if col not in df.columns]
-                if missing:
-                    missing_columns.append(f"Checkbox field '{column}' is missing exploded fields: {missing}")
-            else:
-                print(f"Warning: {column} is marked as checkbox but does not have 'exploded_fields' defined in the data dictionary.")
-        elif column not in df.columns:
-            missing_columns.append(column)
-    return missing_columns
+    print("\n")
 
-# Perform checks
-data_type_inconsistencies = check_data_types(df, data_dictionary)
-value_range_inconsistencies = check_value_ranges(df, data_dictionary)
-checkbox_inconsistencies = check_checkbox_consistency(df, data_dictionary)
-missing_columns = check_missing_columns(df, data_dictionary)
+    with profiling.span('write results'):
+        write_results(results, args.output)
+    summary = summarize_results(results)
+    for row in summary.itertuples(index=False):
+        print(f"{row.rule}: {row.columns} column(s), {row.rows} row(s)")
+    print(f"Results saved to {args.output}.json")
+    if args.profile:
+        summary_path, trace_path = profiling.export()
+        print(f"Profile written to {summary_path} and {trace_path}")
 
-# Print results
-if data_type_inconsistencies:
-    print("\nData type inconsistencies:")
-    for inconsistency in data_type_inconsistencies:
-        print(f"- {inconsistency}")
-else:
-    print("\nData type inconsistencies: None")
+    if args.strict and len(results):
+        exit(1)
 
-if value_range_inconsistencies:
-    print("\nValue range inconsistencies:")
-    for inconsistency in value_range_inconsistencies:
-        print(f"- {inconsistency}")
-else:
-    print("\nValue range inconsistencies: None")
+    return results
 
-if checkbox_inconsistencies:
-    print("\nCheckbox inconsistencies:")
-    for inconsistency in checkbox_inconsistencies:
-        print(f"- {inconsistency}")
-else:
-    print("\nCheckbox inconsistencies: None")
-
-if missing_columns:
-    print("\nMissing columns:")
-    for column in missing_columns:
-        print(f"- {column}")
-else:
-    print("\nMissing columns: None")
-
-print("\n")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,47 @@
+import argparse
 import json
 import os
 from utils import load_data
-from io import BytesIO
+from aggregate import aggregate, distribution_kind, ALL_COHORTS
+from svg_optimize import COMPRESSED_EXTENSIONS, DEFAULT_PRECISION, describe_sizes, optimize_svgs, remove_compressed, write_compressed
+from charts import DEFAULT_RENDERER, DEFAULT_WORKERS, RENDERERS, bar_chart_spec, histogram_spec, render_charts
+from report_cache import entry_fingerprint, evict_entries, read_entry, write_entry
+import profiling
 import pandas as pd
 import numpy as np
 from jinja2 import Environment, FileSystemLoader
-import matplotlib.pyplot as plt
-import seaborn as sns
 import logging
-
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+import re
+
+parser = argparse.ArgumentParser(description='Generate the domain report')
+parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                    help='render charts in this many processes (default: one per CPU)')
+parser.add_argument('--renderer', choices=list(RENDERERS), default=DEFAULT_RENDERER,
+                    help="draw charts with matplotlib or write compact SVG directly ('svg')")
+parser.add_argument('--no-chart-cache', action='store_true',
+                    help='render every chart instead of reusing charts cached in data/cache/charts')
+parser.add_argument('--svg-precision', type=int, default=DEFAULT_PRECISION,
+                    help='decimals kept in chart coordinates when optimizing the charts')
+parser.add_argument('--no-svg-optimize', action='store_true',
+                    help='inline the charts as rendered, without sharing definitions or rounding')
+parser.add_argument('--incremental', action='store_true',
+                    help='reuse entries whose columns, dictionary entries and cohorts are unchanged since the last run')
+parser.add_argument('--split', action='store_true',
+                    help='write a small index page plus one script per domain and view, loaded on demand')
+parser.add_argument('--compress', action='store_true',
+                    help='also write gzip and brotli copies of the report files for servers that serve them directly')
+parser.add_argument('--profile', action='store_true',
+                    help='time every step, chart and entry and write a summary and Chrome trace to data/profile')
 
 # Set paths
 report_path = 'domain_report.html'
+# Domain views of a split report, next to report_path
+fragment_dir = 'domain_report_files'
 domain_map_path = 'reference/domain_map.tsv'
 cohort_var = 'survey'
 
-# Load domain mappings and data
-domain_map = pd.read_csv(domain_map_path, sep='\t')
-data, data_dict = load_data()
-
 # Function to get related columns
-def get_related_columns(column_names):
+def get_related_columns(column_names, data_dict):
     related = {}
     for col in column_names.split(', '):
         if col in data_dict and data_dict[col].get('exploded_fields'):
@@ -32,268 +51,300 @@ def get_related_columns(column_names):
             related[col] = [col]
     return related
 
-# Function to generate histogram and return HTML image
-def generate_histogram(data_series, column, cohort=None):
-    plt.figure(figsize=(10, 6))
-    
-    # Create histogram
-    sns.histplot(data_series.dropna(), bins=20, kde=False, color='skyblue')
-    
-    plt.title(f'Distribution of {column}' + (f' ({cohort})' if cohort else ''))
-    plt.xlabel('Values')
-    plt.ylabel('Frequency')
-    
-    # # Add summary statistics as text
-    # stats = data_series.describe()
-    # stats_text = f"Mean: {stats['mean']:.2f}\nMedian: {stats['50%']:.2f}\nStd: {stats['std']:.2f}"
-    # plt.figtext(0.5, -0.1, stats_text, ha='center', va='center', bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
-    
-    plt.tight_layout()
-    buffer = BytesIO()
-    plt.savefig(buffer, format='svg', bbox_inches='tight')
-    plt.close()
-    buffer.seek(0)
-    return buffer.getvalue().decode('utf-8')
-
-# Function to generate bar chart and return HTML image
-def generate_bar_chart(labels, counts, title, cohort=None, max_count=None):
-    if not counts:
-        return "No data to plot."
-
-    # Filter out 'nan' and non-numeric values
-    valid_data = [(label, count) for label, count in zip(labels, counts) if pd.notna(label) and label != 'nan']
-    
-    if not valid_data:
-        return "No valid data to plot."
-
-    valid_labels, valid_counts = zip(*valid_data)
-
-    num_values = len(valid_labels)
-    # Adjust figure height based on the number of labels to accommodate them
-    fig_height = max(6, num_values * 0.4)
-    plt.figure(figsize=(10, fig_height))
-
-    x = range(len(valid_labels))
-    bars = plt.bar(x, valid_counts, color='skyblue')
-
-    plt.title(f'{title}' + (f' ({cohort})' if cohort else ''))
-    plt.xlabel('Options')
-    plt.ylabel('Counts')
-
-    # Set y-axis limit to max_count if provided
-    # Note: this used to set all y-axes to the same maximum
-    plt.ylim(0, max(valid_counts) * 1.1)
-    # if max_count is not None:
-    #     plt.ylim(0, max_count * 1.1)  # Add 10% padding to the top
-    # else:
-    #     plt.ylim(0, max(valid_counts) * 1.1)
-
-    # Label bars with their counts
-    for bar, count in zip(bars, valid_counts):
-        height = bar.get_height()
-        plt.text(bar.get_x() + bar.get_width() / 2., height,
-                 f'{int(count)}',
-                 ha='center', va='bottom')
-
-    plt.xticks(x, valid_labels, rotation=45, ha='right')
-
-    plt.tight_layout()
-    buffer = BytesIO()
-    plt.savefig(buffer, format='svg', bbox_inches='tight')
-    plt.close()
-    buffer.seek(0)
-    return buffer.getvalue().decode('utf-8')
-
-# Function to compute distributions and maximum counts
-def compute_distributions(data_subset, columns_dict, cohort=None):
+# Charts are collected in scheduled_charts as (distribution, spec) while the
+# entries are built and rendered together once every entry is known
+def schedule_chart(scheduled_charts, distribution, spec):
+    distribution['graph'] = None
+    scheduled_charts.append((distribution, spec))
+
+# Build the distributions of one entry for one cohort (ALL_COHORTS for all rows)
+# from the precomputed statistics, scheduling their charts, and collect max counts
+def build_distributions(stats, columns_dict, cohort, cohort_label, data, data_dict, scheduled_charts):
     distribution_summary = {}
     max_counts = {}
 
     for parent_col, child_cols in columns_dict.items():
-        field_info = data_dict.get(parent_col, {})
-        col_type = field_info.get('type', 'unknown')
-
-        if col_type == 'checkbox' and 'exploded_fields' in field_info:
-            # Handle checkbox fields by aggregating counts of exploded fields
-            counts = {}
-            labels = []
-            for exploded_col in child_cols:
-                value_key = exploded_col.split('_')[-1]
-                labels.append(value_key)
-                if exploded_col in data_subset.columns:
-                    counts[value_key] = data_subset[exploded_col].sum()
-                else:
-                    counts[value_key] = 0  # If the column doesn't exist, count is zero
-
-            distribution_summary[parent_col] = {
-                'counts': counts,
-                'labels': labels,
-                'graph': None  # Will generate graph later
-            }
+        if distribution_kind(parent_col, data_dict) == 'checkbox':
+            # Checkbox fields count the ticked boxes of each exploded field
+            counts = dict(stats['checkbox'][parent_col][cohort])
+            distribution_summary[parent_col] = {'counts': counts, 'labels': list(counts), 'graph': None}
             if counts:
                 max_counts[parent_col] = max(counts.values())
-        else:
-            for col in child_cols:
-                if col not in data_subset.columns:
-                    logging.warning(f"Column '{col}' not found in data")
-                    continue
-
-                col_info = data_dict.get(col, {})
-                col_type = col_info.get('type', 'unknown')
-                if col_type == 'numeric':
-                    # Handle numeric data
-                    numeric_data = pd.to_numeric(data_subset[col], errors='coerce')
-                    if not numeric_data.isna().all():
-                        desc = numeric_data.describe().to_dict()
-                        graph = generate_histogram(numeric_data, col, cohort)
-                        distribution_summary[col] = {
-                            'description': desc,
-                            'graph': graph
-                        }
-                    else:
-                        logging.warning(f"Column '{col}' has no valid numeric data.")
-                        distribution_summary[col] = {
-                            'description': 'No valid numeric data',
-                            'graph': None
-                        }
-                elif col_type in ['radio', 'dropdown', 'text']:
-                    counts = data_subset[col].value_counts(dropna=False).to_dict()
-                    labels = list(map(str, counts.keys()))
-                    graph = generate_bar_chart(
-                        labels,
-                        list(counts.values()),
-                        f'Distribution of {col}',
-                        cohort,
-                        max_count=None
-                    )
-                    distribution_summary[col] = {
-                        'counts': counts,
-                        'labels': labels,
-                        'graph': graph
-                    }
-                    non_nan_counts = {k: v for k, v in counts.items() if pd.notna(k)}
-                    if non_nan_counts:
-                        max_counts[col] = max(non_nan_counts.values())
+            continue
+
+        for col in child_cols:
+            if col not in data.columns:
+                logging.warning(f"Column '{col}' not found in data")
+                continue
+
+            kind = distribution_kind(col, data_dict)
+            if kind == 'numeric':
+                summary = stats['numeric'][col][cohort]
+                if summary is not None:
+                    distribution_summary[col] = {'description': summary['description']}
+                    counts, edges = summary['histogram']
+                    schedule_chart(scheduled_charts, distribution_summary[col], histogram_spec(counts, edges, col, cohort_label))
                 else:
-                    logging.warning(f"Unhandled column type '{col_type}' for column '{col}'")
+                    logging.warning(f"Column '{col}' has no valid numeric data.")
                     distribution_summary[col] = {
-                        'description': f"Unhandled column type: {col_type}",
+                        'description': 'No valid numeric data',
                         'graph': None
                     }
+            elif kind == 'counts':
+                counts = dict(stats['counts'][col][cohort])
+                labels = ['nan' if pd.isna(key) else str(key) for key in counts]
+                distribution_summary[col] = {'counts': counts, 'labels': labels, 'graph': None}
+                non_nan_counts = {k: v for k, v in counts.items() if pd.notna(k)}
+                if non_nan_counts:
+                    max_counts[col] = max(non_nan_counts.values())
+            else:
+                logging.warning(f"Unhandled column type '{kind}' for column '{col}'")
+                distribution_summary[col] = {
+                    'description': f"Unhandled column type: {kind}",
+                    'graph': None
+                }
+                # Still show a histogram when the values parse as numbers
+                summary = stats['numeric'][col][cohort]
+                if summary is not None:
+                    counts, edges = summary['histogram']
+                    schedule_chart(scheduled_charts, distribution_summary[col], histogram_spec(counts, edges, col, cohort_label))
 
     return distribution_summary, max_counts
 
-# Prepare summary data
-summary = []
-domains = []
-
-# Group entries by domain
-domain_entries = {}
-
-for _, row in domain_map.iterrows():
-    domain = row['domain']
-    item = row['item']
-    columns = row['column_name']
-    related_columns = get_related_columns(columns)
-
-    # Compute distributions for all cohorts combined
-    distributions_all, _ = compute_distributions(data, related_columns)
-
-    # Compute distributions for each cohort and collect max counts
-    distributions_by_cohort = {}
-    global_max_counts = {}
-    cohorts = data[cohort_var].unique()
-    for cohort_name in cohorts:
-        cohort_data = data[data[cohort_var] == cohort_name]
-        distributions_cohort, max_counts_cohort = compute_distributions(cohort_data, related_columns, cohort_name)
-        distributions_by_cohort[cohort_name.capitalize()] = distributions_cohort
-
-        # Update global_max_counts with max counts from cohorts
-        for key, value in max_counts_cohort.items():
-            if key not in global_max_counts or value > global_max_counts[key]:
-                global_max_counts[key] = value
-
-    # Generate graphs for all cohorts combined
-    for key, value in distributions_all.items():
+# Schedule the bar charts of a distribution set, with missing values kept out of the chart
+def add_bar_charts(distribution_set, cohort_label, scheduled_charts):
+    for key, value in distribution_set.items():
         if 'counts' in value and value['counts']:
             counts = value['counts']
-            labels = value['labels']
-            nan_count = counts.pop('nan', 0)  # Remove 'nan' and get its count
-            value['graph'] = generate_bar_chart(
+            # Remove the missing values bucket (a NaN or NA key) and get its count
+            nan_count = sum(counts.pop(key) for key in [key for key in counts if pd.isna(key)])
+            schedule_chart(scheduled_charts, value, bar_chart_spec(
                 list(counts.keys()),
                 list(counts.values()),
                 f'Distribution of {key}',
-                'All Cohorts'
-            )
+                cohort_label
+            ))
             # Add 'nan' count to the summary if it exists
             if nan_count > 0:
                 value['nan_count'] = nan_count
-        elif 'description' in value and value['description']:
-            # Generate histogram for numeric data
-            numeric_data = pd.to_numeric(data[key], errors='coerce')
-            value['graph'] = generate_histogram(numeric_data, key, 'All Cohorts')
-
-    # Generate graphs for each cohort using global_max_counts from cohorts only
-    for cohort_name, distribution_set in distributions_by_cohort.items():
-        for key, value in distribution_set.items():
-            if 'counts' in value and value['counts']:
-                counts = value['counts']
-                nan_count = counts.pop('nan', 0)  # Remove 'nan' and get its count
-                graph = generate_bar_chart(
-                    list(counts.keys()),
-                    list(counts.values()),
-                    f'Distribution of {key}',
-                    cohort_name,
-                    max_count=global_max_counts.get(key)
-                )
-                distribution_set[key]['graph'] = graph
-                # Add 'nan' count to the summary if it exists
-                if nan_count > 0:
-                    distribution_set[key]['nan_count'] = nan_count
-            elif 'description' in value and value['description']:
-                # Generate histogram for numeric data
-                numeric_data = pd.to_numeric(data[data[cohort_var] == cohort_name.lower()][key], errors='coerce')
-                graph = generate_histogram(numeric_data, key, cohort_name)
-                distribution_set[key]['graph'] = graph
-
-    # Retrieve column labels and types
-    column_details = {}
-    for parent_col, child_cols in related_columns.items():
-        field_info = data_dict.get(parent_col, {})
-        column_details[parent_col] = {
-            'label': field_info.get('label', ''),
-            'type': field_info.get('type', ''),
-            'value_labels': field_info.get('value_labels', {})
+
+# Build the report and write it to report_path. data is an optional
+# (DataFrame, data dictionary) pair of the typed dataset, as returned by
+# load_data(), so a caller that already loaded it (see pipeline.py) does not
+# read it again.
+def main(argv=None, data=None):
+    # parse_known_args keeps this runnable from Jupyter, which passes its own arguments
+    args, _ = parser.parse_known_args(argv)
+
+    # Set up logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.profile:
+        profiling.enable('report')
+
+    # Load domain mappings and data
+    domain_map = pd.read_csv(domain_map_path, sep='\t')
+    # Only the columns referenced by the domain map are read, unless the caller
+    # passes the loaded dataset
+    report_fields = [col for names in domain_map['column_name'] for col in names.split(', ')]
+    with profiling.span('load data'):
+        data, data_dict = data if data is not None else load_data(columns=report_fields)
+
+    # With --incremental, entries whose inputs have the same fingerprint as in an
+    # earlier run are read from the entry cache and only the others are built
+    fingerprints = {}
+    cached_entries = {}
+    if args.incremental:
+        column_hashes = {}
+        for index, row in domain_map.iterrows():
+            with profiling.span('fingerprint entry', domain=row['domain'], item=row['item']):
+                fingerprints[index] = entry_fingerprint(
+                    [row['domain'], row['item'], row['column_name']], get_related_columns(row['column_name'], data_dict),
+                    data, data_dict, cohort_var, args.renderer, column_hashes)
+                entry = read_entry(fingerprints[index])
+            if entry is not None:
+                cached_entries[index] = entry
+
+    # Every value count, checkbox sum and numeric summary the entries to build show,
+    # for each cohort and all cohorts, computed in one grouped pass
+    # (checkbox fields by their parent, every other field by its columns)
+    stats_columns = []
+    for index, names in domain_map['column_name'].items():
+        if index in cached_entries:
+            continue
+        for parent_col, child_cols in get_related_columns(names, data_dict).items():
+            if distribution_kind(parent_col, data_dict) == 'checkbox':
+                stats_columns.append(parent_col)
+            else:
+                stats_columns.extend(child_cols)
+    if len(cached_entries) < len(domain_map):
+        with profiling.span('aggregate', columns=len(set(stats_columns))):
+            stats = aggregate(data, data_dict, list(dict.fromkeys(stats_columns)), cohort_var)
+
+    # Prepare summary data
+    summary = []
+    domains = []
+    scheduled_charts = []
+
+    # Group entries by domain
+    domain_entries = {}
+    built_entries = {}
+
+    for index, row in domain_map.iterrows():
+        domain = row['domain']
+        item = row['item']
+        columns = row['column_name']
+        related_columns = get_related_columns(columns, data_dict)
+
+        if index in cached_entries:
+            domain_entries.setdefault(domain, []).append(cached_entries[index])
+            continue
+        entry_span = profiling.begin('build entry', domain=domain, item=item)
+
+        # Distributions for all cohorts combined
+        distributions_all, _ = build_distributions(stats, related_columns, ALL_COHORTS, 'All Cohorts',
+                                                   data, data_dict, scheduled_charts)
+        add_bar_charts(distributions_all, 'All Cohorts', scheduled_charts)
+
+        # Distributions for each cohort and max counts across cohorts
+        distributions_by_cohort = {}
+        global_max_counts = {}
+        for cohort_name in stats['cohorts']:
+            distributions_cohort, max_counts_cohort = build_distributions(
+                stats, related_columns, cohort_name, cohort_name.capitalize(), data, data_dict, scheduled_charts)
+            distributions_by_cohort[cohort_name.capitalize()] = distributions_cohort
+
+            # Update global_max_counts with max counts from cohorts
+            for key, value in max_counts_cohort.items():
+                if key not in global_max_counts or value > global_max_counts[key]:
+                    global_max_counts[key] = value
+
+        # Bar charts for each cohort (generate_bar_chart no longer applies global_max_counts)
+        for cohort_name, distribution_set in distributions_by_cohort.items():
+            add_bar_charts(distribution_set, cohort_name, scheduled_charts)
+
+        # Retrieve column labels and types
+        column_details = {}
+        for parent_col, child_cols in related_columns.items():
+            field_info = data_dict.get(parent_col, {})
+            column_details[parent_col] = {
+                'label': field_info.get('label', ''),
+                'type': field_info.get('type', ''),
+                'value_labels': field_info.get('value_labels', {})
+            }
+
+        entry = {
+            'domain': domain,
+            'item': item,
+            'columns': column_details,
+            'distributions_all': distributions_all,
+            'distributions_by_cohort': distributions_by_cohort
         }
 
-    entry = {
-        'domain': domain,
-        'item': item,
-        'columns': column_details,
-        'distributions_all': distributions_all,
-        'distributions_by_cohort': distributions_by_cohort
-    }
-
-    if domain not in domain_entries:
-        domain_entries[domain] = []
-    domain_entries[domain].append(entry)
-
-# Create domains list for the template
-for domain, entries in domain_entries.items():
-    domains.append({
-        'id': domain.lower().replace(' ', '_'),
-        'description': domain,
-        'entries': entries
-    })
-
-# Generate HTML report using Jinja2
-env = Environment(loader=FileSystemLoader('.'))
-report_template = env.get_template('templates/report.html')
-
-html_content = report_template.render(domains=domains)
-
-# Write HTML report to file
-with open(report_path, 'w') as f:
-    f.write(html_content)
-
-logging.info(f"Domain report has been successfully generated as '{report_path}'. You can open it in your web browser to review the updated report.")
+        if domain not in domain_entries:
+            domain_entries[domain] = []
+        domain_entries[domain].append(entry)
+        built_entries[index] = entry
+        profiling.end(entry_span)
+
+    # Render every scheduled chart once, then put the SVGs back into the entries
+    # (charts unchanged since an earlier run are read from the chart cache)
+    with profiling.span('render charts', graphs=len(scheduled_charts), renderer=args.renderer):
+        svgs, chart_stats = render_charts([spec for _, spec in scheduled_charts], args.workers,
+                                          cache=not args.no_chart_cache, renderer=args.renderer)
+    logging.info(f"{chart_stats['charts']} charts for {len(scheduled_charts)} graphs: "
+                 f"{chart_stats['hits']} cached, {chart_stats['misses']} rendered ({args.renderer}) with {args.workers} worker(s), "
+                 f"{chart_stats['evicted']} evicted from the chart cache")
+
+    for (distribution, _), svg in zip(scheduled_charts, svgs):
+        distribution['graph'] = svg
+
+    # Cache the built entries as rendered, before the page-level optimization below
+    if args.incremental:
+        for index, entry in built_entries.items():
+            write_entry(fingerprints[index], entry)
+        evicted = evict_entries(set(fingerprints.values()))
+        logging.info(f"Incremental build: {len(cached_entries)} entries reused, {len(built_entries)} rebuilt, "
+                     f"{evicted} stale entries evicted")
+
+    # Share glyph, marker and clip path definitions between the charts of every
+    # entry and round their coordinates; the shared definitions are placed once in the page
+    shared_defs = ''
+    if not args.no_svg_optimize:
+        graphs = [distribution
+                  for entries in domain_entries.values() for entry in entries
+                  for distributions in [entry['distributions_all'], *entry['distributions_by_cohort'].values()]
+                  for distribution in distributions.values() if isinstance(distribution.get('graph'), str)]
+        svgs = [distribution['graph'] for distribution in graphs]
+        before = sum(len(svg.encode('utf-8')) for svg in svgs)
+        with profiling.span('optimize charts', charts=len(svgs)):
+            svgs, shared_defs = optimize_svgs(svgs, args.svg_precision)
+        after = sum(len(svg.encode('utf-8')) for svg in svgs) + len(shared_defs.encode('utf-8'))
+        logging.info(f"Optimized charts: {before:,} -> {after:,} bytes "
+                     f"(including {len(shared_defs.encode('utf-8')):,} bytes of shared definitions)")
+        for distribution, svg in zip(graphs, svgs):
+            distribution['graph'] = svg
+
+    # Create domains list for the template
+    for domain, entries in domain_entries.items():
+        domains.append({
+            'id': domain.lower().replace(' ', '_'),
+            'file': re.sub(r'[^a-z0-9_-]+', '_', domain.lower()),
+            'description': domain,
+            'entries': entries
+        })
+
+    # Generate HTML report using Jinja2
+    env = Environment(loader=FileSystemLoader('.'))
+    report_template = env.get_template('templates/report.html')
+
+    if args.split:
+        # One script per domain and view; the index page loads them as they are shown
+        fragment_template = env.get_template('templates/domain_fragment.html')
+        os.makedirs(fragment_dir, exist_ok=True)
+        written = set()
+        for domain in domains:
+            for view in ['combined', 'by-cohort']:
+                name = f"{domain['file']}-{view}.js"
+                with profiling.span('render fragment', domain=domain['description'], view=view):
+                    fragment = fragment_template.render(domain=domain, view=view)
+                with open(os.path.join(fragment_dir, name), 'w') as f:
+                    f.write(f"reportFragment({json.dumps(domain['id'])}, {json.dumps(view)}, {json.dumps(fragment)});\n")
+                written.add(name)
+        # Drop views of domains no longer in the report
+        for name in os.listdir(fragment_dir):
+            script = name[:-3] if name.endswith(COMPRESSED_EXTENSIONS) else name
+            if script.endswith('.js') and script not in written:
+                os.remove(os.path.join(fragment_dir, name))
+        with profiling.span('render template'):
+            html_content = report_template.render(domains=domains, split=True, fragment_dir=fragment_dir,
+                                                  shared_defs=shared_defs)
+    else:
+        with profiling.span('render template'):
+            html_content = report_template.render(domains=domains, shared_defs=shared_defs)
+
+    # Write HTML report to file
+    with open(report_path, 'w') as f:
+        f.write(html_content)
+
+    # Precompressed copies for web servers that serve them directly. Maximum
+    # compression is slow, so it is opt-in; copies left by an earlier run are
+    # removed otherwise, as they no longer match.
+    artifacts = [report_path]
+    if args.split:
+        artifacts += [os.path.join(fragment_dir, name) for name in sorted(written)]
+    for path in artifacts:
+        if args.compress:
+            with profiling.span('compress', file=path):
+                sizes = write_compressed(path)
+            logging.info(f"Wrote {describe_sizes(path, sizes)}")
+        else:
+            remove_compressed(path)
+
+    logging.info(f"Domain report has been successfully generated as '{report_path}'. You can open it in your web browser to review the updated report.")
+    if args.profile:
+        summary_path, trace_path = profiling.export()
+        logging.info(f"Profile written to {summary_path} and {trace_path}")
+    return report_path
+
+if __name__ == '__main__':
+    main()
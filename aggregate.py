@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+import profiling
+
+# Cohort key for statistics over every row
+ALL_COHORTS = None
+
+# Field types summarised by value counts; 'numeric' fields get summary
+# statistics and a histogram, checkboxes a count per exploded column
+COUNT_TYPES = ['radio', 'dropdown', 'text']
+
+# How a report column is summarised: 'checkbox', 'numeric', 'counts' or the
+# unhandled field type
+def distribution_kind(field, data_dictionary):
+    info = data_dictionary.get(field, {})
+    field_type = info.get('type', 'unknown')
+    if field_type == 'checkbox' and 'exploded_fields' in info:
+        return 'checkbox'
+    if field_type == 'numeric':
+        return 'numeric'
+    if field_type in COUNT_TYPES:
+        return 'counts'
+    return field_type
+
+# Precomputed distributions of the report columns for every cohort and for all
+# rows, from a single grouping of the rows by cohort:
+#   counts[column][cohort]    {value: count} as Series.value_counts(dropna=False)
+#   checkbox[field][cohort]   {code: number of rows with the box ticked}
+#   numeric[column][cohort]   {'description': describe() dict, 'histogram':
+#                             (counts, edges)}, or None without numeric data;
+#                             also kept for columns of unhandled types
+# Cohorts are keyed by their value in cohort_var (in order of appearance, see
+# 'cohorts') and ALL_COHORTS.
+def aggregate(data, data_dictionary, fields, cohort_var='survey', bins=20):
+    with profiling.span('group cohorts', rows=len(data)):
+        cohort_codes, cohorts = pd.factorize(data[cohort_var], sort=False)
+        cohorts = list(cohorts)
+        # Row positions of each cohort, shared by every numeric column
+        positions = {ALL_COHORTS: np.arange(len(data))}
+        order = np.argsort(cohort_codes, kind='stable')
+        bounds = np.searchsorted(cohort_codes[order], np.arange(len(cohorts) + 1))
+        for i, cohort in enumerate(cohorts):
+            positions[cohort] = order[bounds[i]:bounds[i + 1]]
+
+    result = {'cohorts': cohorts, 'counts': {}, 'checkbox': {}, 'numeric': {}}
+    checkbox_columns = {}
+    for field in fields:
+        kind = distribution_kind(field, data_dictionary)
+        if kind == 'checkbox':
+            checkbox_columns[field] = data_dictionary[field]['exploded_fields']
+        elif field in data.columns and kind == 'counts':
+            with profiling.span('value counts', column=field):
+                result['counts'][field] = value_counts(data[field], cohort_codes, cohorts)
+        elif field in data.columns:
+            # Numeric fields, and any field of an unhandled type that parses as numbers
+            with profiling.span('numeric summary', column=field):
+                values = pd.to_numeric(data[field], errors='coerce')
+                result['numeric'][field] = {cohort: numeric_summary(values.iloc[rows], bins)
+                                            for cohort, rows in positions.items()}
+
+    # One grouped sum over every exploded checkbox column
+    exploded = list(dict.fromkeys(col for cols in checkbox_columns.values() for col in cols if col in data.columns))
+    with profiling.span('checkbox sums', columns=len(exploded)):
+        ticked = {ALL_COHORTS: data[exploded].sum()}
+        by_cohort = data[exploded].groupby(cohort_codes).sum()
+    for i, cohort in enumerate(cohorts):
+        ticked[cohort] = by_cohort.loc[i] if i in by_cohort.index else pd.Series(0, index=exploded)
+    for field, cols in checkbox_columns.items():
+        result['checkbox'][field] = {
+            cohort: {col.split('_')[-1]: int(sums[col]) if col in sums.index else 0 for col in cols}
+            for cohort, sums in ticked.items()
+        }
+    return result
+
+# Value counts of one column for every cohort, from one bincount over
+# (cohort, value) codes. Matches Series.value_counts(dropna=False) on each
+# cohort: declared but unobserved categories count as 0, missing values are
+# keyed by the column's NA value and ties keep value_counts' order (order of
+# appearance within the cohort).
+def value_counts(series, cohort_codes, cohorts):
+    categorical = isinstance(series.dtype, pd.CategoricalDtype)
+    if categorical:
+        # Categories first and missing values (code -1) last
+        codes = series.cat.codes.to_numpy().astype('int64')
+        codes[codes < 0] = len(series.cat.categories)
+        keys = list(series.cat.categories) + [np.nan]
+    else:
+        # Values and missing values in order of appearance
+        codes, uniques = pd.factorize(series, sort=False, use_na_sentinel=False)
+        keys = list(uniques)
+    width = len(keys)
+    grouped = cohort_codes >= 0
+    table = np.bincount(cohort_codes[grouped] * width + codes[grouped],
+                        minlength=len(cohorts) * width).reshape(len(cohorts), width)
+    counts = {ALL_COHORTS: np.bincount(codes, minlength=width)}
+    counts.update(zip(cohorts, table))
+    # value_counts breaks ties by order of appearance, which for a cohort is not
+    # the order over the whole column: list each cohort's values as they first
+    # appear in it
+    appearance = {ALL_COHORTS: np.arange(width)}
+    if not categorical:
+        pairs, first = np.unique(cohort_codes[grouped] * width + codes[grouped], return_index=True)
+        pairs = pairs[np.argsort(first, kind='stable')]
+        appearance.update((cohort, pairs[pairs // width == i] % width) for i, cohort in enumerate(cohorts))
+    # Nullable numbers count their missing values after every other value, in
+    # nullable counts
+    masked = isinstance(series.array, (pd.arrays.IntegerArray, pd.arrays.FloatingArray, pd.arrays.BooleanArray))
+    if masked:
+        missing = [i for i, key in enumerate(keys) if pd.isna(key)]
+        appearance = {cohort: np.concatenate([order[~np.isin(order, missing)], order[np.isin(order, missing)]])
+                      for cohort, order in appearance.items()}
+    # Sort like value_counts would, on a count Series of the same type
+    if masked:
+        count_dtype = 'Int64'
+    elif isinstance(series.dtype, pd.StringDtype) and series.dtype.storage == 'pyarrow':
+        count_dtype = 'int64[pyarrow]'
+    else:
+        count_dtype = 'int64'
+    result = {}
+    for cohort, row in counts.items():
+        order = appearance.get(cohort, appearance[ALL_COHORTS])
+        ordered = pd.Series(row[order], index=order, dtype=count_dtype).sort_values(ascending=False)
+        # Categoricals list every category but missing values only when present
+        result[cohort] = {keys[i]: int(n) for i, n in ordered.items()
+                          if n or (categorical and i < width - 1)}
+    return result
+
+# describe() of the non-missing values with a histogram of them, or None without any
+def numeric_summary(series, bins):
+    values = series.to_numpy(dtype='float64', na_value=np.nan)
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return None
+    counts, edges = np.histogram(values, bins=bins)
+    return {'description': series.describe().to_dict(), 'histogram': (counts, edges)}
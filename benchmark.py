@@ -0,0 +1,235 @@
+#!/bin/env python3
+
+# Benchmarks for the pipeline stages. Each subcommand prints a small table of
+# wall time, throughput and peak traced memory (tracemalloc, which also counts
+# numpy/pandas buffers).
+#
+#   python benchmark.py export --source data/raw --batch-sizes 100 500
+#   python benchmark.py load --domains Economic
+#   python benchmark.py validate --workers 1 2 4
+#   python benchmark.py charts --domains Economic
+#   python benchmark.py scale --rows 10000 100000 --domains Economic
+
+import argparse
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from aggregate import ALL_COHORTS, aggregate, distribution_kind
+from charts import RENDERERS, bar_chart_spec, histogram_spec, render_charts
+from combine import SURVEY_CATEGORIES
+from redcap_pull import pull_project
+from synthetic import generate, parse_mix
+from utils import DOMAIN_MAP, combined_columns, data_file, domain_fields, evict_snapshots, load_data
+from validation import compile_rules, evaluate_rules, validate, validate_parallel
+
+# Run fn under tracemalloc; returns (result, seconds, peak bytes)
+def measure(fn, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+def print_table(header, rows):
+    widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+    for row in [header] + rows:
+        print('  '.join(str(value).rjust(width) for value, width in zip(row, widths)))
+
+# Start mock_redcap.py in a subprocess so its memory is not traced
+def start_mock_redcap(source):
+    mock = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_redcap.py'),
+         '--source', source, '--port', '0'],
+        stdout=subprocess.PIPE, text=True)
+    api_url = mock.stdout.readline().split('=', 1)[1].strip().strip('"')
+    token = json.loads(mock.stdout.readline().split('=', 1)[1].strip().strip("'"))
+    return mock, api_url, token
+
+# Single-request export against batched, streamed exports for every project in source
+def bench_export(args):
+    mock, api_url, token = start_mock_redcap(args.source)
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory() as raw_dir:
+            for key, api_key in token.items():
+                for batch_size in [0] + args.batch_sizes:
+                    (_, timings, _), elapsed, peak = measure(
+                        pull_project, key, api_url, api_key, raw_dir, batch_size=batch_size)
+                    size = os.path.getsize(data_file(os.path.join(raw_dir, key)))
+                    rows.append([
+                        key,
+                        batch_size or 'single',
+                        timings['rows'],
+                        f"{elapsed:.2f}",
+                        f"{timings['rows'] / elapsed:.0f}",
+                        f"{size / elapsed / 2**20:.1f}",
+                        f"{peak / 2**20:.1f}",
+                    ])
+    finally:
+        mock.terminate()
+    print_table(['project', 'batch', 'records', 'seconds', 'records/s', 'MB/s', 'peak MB'], rows)
+
+# Typed load of the combined dataset without the snapshot cache, with a cold
+# cache (snapshot written) and with a warm cache (snapshot read)
+def bench_load(args):
+    kwargs = {'domains': args.domains, 'cohorts': args.cohorts}
+    evict_snapshots()
+    rows = []
+    for label, cache in [('no cache', False), ('cold', True), ('warm', True)]:
+        (df, _), elapsed, peak = measure(load_data, cache=cache, **kwargs)
+        rows.append([label, len(df), len(df.columns), f"{elapsed:.2f}", f"{peak / 2**20:.1f}"])
+    print_table(['load', 'rows', 'columns', 'seconds', 'peak MB'], rows)
+
+# Single-process validation against the process pool at each worker count.
+# Wall time only: tracemalloc cannot see the workers' memory.
+def bench_validate(args):
+    columns, data_dictionary = combined_columns()
+    start = time.perf_counter()
+    results = validate(load_data(cache=False)[0], data_dictionary)
+    serial = time.perf_counter() - start
+    rows = [['serial', len(columns), len(results), f"{serial:.2f}", '1.00']]
+    for workers in args.workers:
+        start = time.perf_counter()
+        results = validate_parallel(data_dictionary, columns, workers, chunksize=args.chunksize)
+        elapsed = time.perf_counter() - start
+        rows.append([workers, len(columns), len(results), f"{elapsed:.2f}", f"{serial / elapsed:.2f}"])
+    print(f"{os.cpu_count()} CPU(s)")
+    print_table(['workers', 'columns', 'failures', 'seconds', 'speedup'], rows)
+
+# Columns the report aggregates for the given fields: checkbox parents and the
+# exploded columns of other fields
+def report_columns(data_dictionary, fields):
+    columns = []
+    for field in fields:
+        if distribution_kind(field, data_dictionary) == 'checkbox':
+            columns.append(field)
+        else:
+            columns.extend(data_dictionary.get(field, {}).get('exploded_fields', [field]))
+    return list(dict.fromkeys(columns))
+
+# Chart specs of the report charts from aggregate() statistics: bar charts of
+# value counts and checkboxes and histograms of numeric columns, for all
+# cohorts and each cohort
+def report_chart_specs(stats):
+    labels = {ALL_COHORTS: 'All Cohorts', **{cohort: cohort.capitalize() for cohort in stats['cohorts']}}
+    specs = []
+    for kind in ['counts', 'checkbox']:
+        for column, by_cohort in stats[kind].items():
+            for cohort, counts in by_cohort.items():
+                counts = {key: value for key, value in counts.items() if not pd.isna(key)}
+                specs.append(bar_chart_spec(counts.keys(), counts.values(), f'Distribution of {column}', labels[cohort]))
+    for column, by_cohort in stats['numeric'].items():
+        for cohort, summary in by_cohort.items():
+            if summary is not None:
+                specs.append(histogram_spec(*summary['histogram'], column, labels[cohort]))
+    return list(dict.fromkeys(specs))
+
+# Parent fields of the given domains, or of the whole domain map
+def report_fields(domains=None):
+    if domains:
+        return domain_fields(domains)
+    return [field for names in pd.read_csv(DOMAIN_MAP, sep='\t')['column_name'] for field in names.split(', ')]
+
+# Render time and output size of the report charts with each renderer, in one
+# process and without the chart cache
+def bench_charts(args):
+    data, data_dictionary = load_data(domains=args.domains)
+    stats = aggregate(data, data_dictionary, report_columns(data_dictionary, report_fields(args.domains)))
+    specs = report_chart_specs(stats)
+    rows = []
+    for renderer in args.renderers:
+        start = time.perf_counter()
+        svgs, _ = render_charts(specs, workers=1, cache=False, renderer=renderer)
+        elapsed = time.perf_counter() - start
+        size = sum(len(svg.encode('utf-8')) for svg in svgs)
+        gzipped = sum(len(gzip.compress(svg.encode('utf-8'))) for svg in svgs)
+        rows.append([renderer, len(specs), f"{elapsed:.2f}", f"{len(specs) / elapsed:.0f}",
+                     f"{size / 2**20:.2f}", f"{gzipped / 2**20:.2f}", f"{size / len(specs) / 2**10:.1f}"])
+    print_table(['renderer', 'charts', 'seconds', 'charts/s', 'MB', 'gzip MB', 'KB/chart'], rows)
+
+# Generate synthetic datasets of each size (see synthetic.py) and time the
+# stages on them: the typed load, each validation rule, the report aggregation
+# and chart rendering with each renderer. Stages run in the generated tree, as
+# every path is relative to the working directory.
+def bench_scale(args):
+    mix = parse_mix(args.cohorts)
+    rows = []
+    for size in args.rows:
+        with tempfile.TemporaryDirectory() as workdir:
+            _, elapsed, peak = measure(generate, workdir, size, mix, args.seed, invalid_rate=args.invalid_rate)
+            rows.append([size, 'generate', '', f"{elapsed:.2f}", f"{size / elapsed:.0f}", f"{peak / 2**20:.1f}"])
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                (data, data_dictionary), elapsed, peak = measure(load_data, domains=args.domains, cache=False)
+                rows.append([size, 'load', len(data.columns), f"{elapsed:.2f}", f"{size / elapsed:.0f}", f"{peak / 2**20:.1f}"])
+
+                rules = compile_rules(data_dictionary, data.columns)
+                record_id = next(iter(data_dictionary))
+                for rule, checks in rules.groupby('rule', sort=False):
+                    _, elapsed, peak = measure(evaluate_rules, data, checks, record_id)
+                    rows.append([size, f'validate {rule}', len(checks), f"{elapsed:.2f}", f"{size / elapsed:.0f}",
+                                 f"{peak / 2**20:.1f}"])
+
+                columns = report_columns(data_dictionary, report_fields(args.domains))
+                stats, elapsed, peak = measure(aggregate, data, data_dictionary, columns)
+                rows.append([size, 'aggregate', len(columns), f"{elapsed:.2f}", f"{size / elapsed:.0f}", f"{peak / 2**20:.1f}"])
+
+                specs = report_chart_specs(stats)
+                for renderer in args.renderers:
+                    _, elapsed, peak = measure(render_charts, specs, workers=1, cache=False, renderer=renderer)
+                    rows.append([size, f'render {renderer}', len(specs), f"{elapsed:.2f}", f"{size / elapsed:.0f}",
+                                 f"{peak / 2**20:.1f}"])
+            finally:
+                os.chdir(cwd)
+    print_table(['rows', 'stage', 'items', 'seconds', 'rows/s', 'peak MB'], rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pipeline stages')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='single-request vs batched REDCap export')
+    export_parser.add_argument('--source', default='data/raw', help='raw datasets served through mock_redcap.py')
+    export_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 500])
+    export_parser.set_defaults(func=bench_export)
+
+    load_parser = subparsers.add_parser('load', help='typed load_data with and without the snapshot cache')
+    load_parser.add_argument('--domains', nargs='+', help='load only the columns of these domains')
+    load_parser.add_argument('--cohorts', nargs='+', help='load only rows of these cohorts')
+    load_parser.set_defaults(func=bench_load)
+
+    validate_parser = subparsers.add_parser('validate', help='single-process vs process-parallel validation')
+    validate_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    validate_parser.add_argument('--chunksize', type=int, help='stream each shard in chunks of this many rows')
+    validate_parser.set_defaults(func=bench_validate)
+
+    charts_parser = subparsers.add_parser('charts', help='matplotlib vs native SVG chart rendering')
+    charts_parser.add_argument('--domains', nargs='+', help='render only the charts of these domains')
+    charts_parser.add_argument('--renderers', nargs='+', choices=list(RENDERERS), default=list(RENDERERS))
+    charts_parser.set_defaults(func=bench_charts)
+
+    scale_parser = subparsers.add_parser('scale', help='all stages on synthetic datasets of increasing size')
+    scale_parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    scale_parser.add_argument('--cohorts', nargs='+', default=[f'{cohort}=1' for cohort in SURVEY_CATEGORIES],
+                              help='cohort mix as cohort=weight (default: equal shares)')
+    scale_parser.add_argument('--seed', type=int, default=0)
+    scale_parser.add_argument('--invalid-rate', type=float, default=0.001,
+                              help='share of radio/dropdown answers outside the declared codes')
+    scale_parser.add_argument('--domains', nargs='+', help='load and report only these domains')
+    scale_parser.add_argument('--renderers', nargs='+', choices=list(RENDERERS), default=['svg'])
+    scale_parser.set_defaults(func=bench_scale)
+
+    args = parser.parse_args()
+    args.func(args)
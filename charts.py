@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+
+import matplotlib
+# Charts are only written to SVG; Agg needs no display in the main process or the workers
+matplotlib.use('Agg')
+# Derive SVG ids from content only, so a glyph, marker or clip path has the same
+# id in every chart (svg_optimize.py shares them) and charts render reproducibly
+matplotlib.rcParams['svg.hashsalt'] = 'domain-report'
+import matplotlib.pyplot as plt
+import pandas as pd
+import seaborn as sns
+
+import profiling
+from svg_charts import svg_bar_chart, svg_histogram
+from utils import CACHE_DIR
+
+# Default number of chart rendering processes; override with --workers or REPORT_WORKERS
+DEFAULT_WORKERS = int(os.getenv('REPORT_WORKERS', os.cpu_count() or 1))
+
+# Default chart renderer ('matplotlib' or 'svg', see RENDERERS); override with
+# --renderer or REPORT_RENDERER
+DEFAULT_RENDERER = os.getenv('REPORT_RENDERER', 'matplotlib')
+
+# Rendered charts are cached as <spec hash>.svg; the oldest are evicted once the
+# cache grows past REPORT_CHART_CACHE_MB
+CHART_CACHE_DIR = os.path.join(CACHE_DIR, 'charts')
+CHART_CACHE_SIZE = int(os.getenv('REPORT_CHART_CACHE_MB', 256)) * 2**20
+# Bump when generate_bar_chart or generate_histogram draw differently, so cached
+# charts are redrawn
+CHART_STYLE_VERSION = 2
+
+# Chart specs are plain tuples, so identical charts compare equal and pickle
+# cheaply to worker processes:
+#   ('bar', labels, counts, title, cohort)
+#   ('histogram', counts, edges, column, cohort)
+def bar_chart_spec(labels, counts, title, cohort=None):
+    return ('bar', tuple(labels), tuple(counts), title, cohort)
+
+def histogram_spec(counts, edges, column, cohort=None):
+    return ('histogram', tuple(counts), tuple(edges), column, cohort)
+
+# Function to generate histogram from precomputed bin counts and edges and return HTML image
+def generate_histogram(counts, edges, column, cohort=None):
+    plt.figure(figsize=(10, 6))
+
+    # Create histogram; weighting each bin's left edge by its count redraws the same bars
+    sns.histplot(x=edges[:-1], weights=counts, bins=list(edges), kde=False, color='skyblue')
+
+    plt.title(f'Distribution of {column}' + (f' ({cohort})' if cohort else ''))
+    plt.xlabel('Values')
+    plt.ylabel('Frequency')
+
+    # # Add summary statistics as text
+    # stats = data_series.describe()
+    # stats_text = f"Mean: {stats['mean']:.2f}\nMedian: {stats['50%']:.2f}\nStd: {stats['std']:.2f}"
+    # plt.figtext(0.5, -0.1, stats_text, ha='center', va='center', bbox=dict(boxstyle='round', facecolor='white', alpha=0.8))
+
+    plt.tight_layout()
+    buffer = BytesIO()
+    plt.savefig(buffer, format='svg', bbox_inches='tight')
+    plt.close()
+    buffer.seek(0)
+    return buffer.getvalue().decode('utf-8')
+
+# Function to generate bar chart and return HTML image
+def generate_bar_chart(labels, counts, title, cohort=None, max_count=None):
+    if not counts:
+        return "No data to plot."
+
+    # Filter out 'nan' and non-numeric values
+    valid_data = [(label, count) for label, count in zip(labels, counts) if pd.notna(label) and label != 'nan']
+
+    if not valid_data:
+        return "No valid data to plot."
+
+    valid_labels, valid_counts = zip(*valid_data)
+
+    num_values = len(valid_labels)
+    # Adjust figure height based on the number of labels to accommodate them
+    fig_height = max(6, num_values * 0.4)
+    plt.figure(figsize=(10, fig_height))
+
+    x = range(len(valid_labels))
+    bars = plt.bar(x, valid_counts, color='skyblue')
+
+    plt.title(f'{title}' + (f' ({cohort})' if cohort else ''))
+    plt.xlabel('Options')
+    plt.ylabel('Counts')
+
+    # Set y-axis limit to max_count if provided
+    # Note: this used to set all y-axes to the same maximum
+    plt.ylim(0, max(valid_counts) * 1.1)
+    # if max_count is not None:
+    #     plt.ylim(0, max_count * 1.1)  # Add 10% padding to the top
+    # else:
+    #     plt.ylim(0, max(valid_counts) * 1.1)
+
+    # Label bars with their counts
+    for bar, count in zip(bars, valid_counts):
+        height = bar.get_height()
+        plt.text(bar.get_x() + bar.get_width() / 2., height,
+                 f'{int(count)}',
+                 ha='center', va='bottom')
+
+    plt.xticks(x, valid_labels, rotation=45, ha='right')
+
+    plt.tight_layout()
+    buffer = BytesIO()
+    plt.savefig(buffer, format='svg', bbox_inches='tight')
+    plt.close()
+    buffer.seek(0)
+    return buffer.getvalue().decode('utf-8')
+
+# Bar chart and histogram functions of each renderer. 'svg' writes compact SVG
+# directly (svg_charts.py); 'matplotlib' draws the charts with matplotlib/seaborn.
+RENDERERS = {
+    'matplotlib': (generate_bar_chart, generate_histogram),
+    'svg': (svg_bar_chart, svg_histogram),
+}
+
+def render_chart(spec, renderer=DEFAULT_RENDERER):
+    bar_chart, histogram = RENDERERS[renderer]
+    kind, *args = spec
+    if kind == 'bar':
+        labels, counts, title, cohort = args
+        with profiling.span('render bar chart', title=title, cohort=cohort, renderer=renderer):
+            return bar_chart(list(labels), list(counts), title, cohort)
+    counts, edges, column, cohort = args
+    with profiling.span('render histogram', column=column, cohort=cohort, renderer=renderer):
+        return histogram(list(counts), list(edges), column, cohort)
+
+# Cache key of a spec: its content, the renderer, the chart style version and
+# the plotting library versions. Values are keyed with their type, so 1 and '1'
+# differ.
+def chart_key(spec, renderer=DEFAULT_RENDERER):
+    content = [CHART_STYLE_VERSION, renderer, matplotlib.__version__, sns.__version__, spec]
+    encoded = json.dumps(content, default=lambda value: [type(value).__name__, str(value)])
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+def chart_path(key):
+    return os.path.join(CHART_CACHE_DIR, key + '.svg')
+
+def read_chart(key):
+    path = chart_path(key)
+    try:
+        with open(path, encoding='utf-8') as f:
+            svg = f.read()
+    except FileNotFoundError:
+        return None
+    # A hit counts as a use for eviction
+    os.utime(path)
+    return svg
+
+def write_chart(key, svg):
+    os.makedirs(CHART_CACHE_DIR, exist_ok=True)
+    path = chart_path(key)
+    with open(path + '.part', 'w', encoding='utf-8') as f:
+        f.write(svg)
+    os.replace(path + '.part', path)
+
+# Remove the least recently used charts until the cache fits in max_bytes.
+# Returns the number of charts removed.
+def evict_charts(max_bytes=CHART_CACHE_SIZE):
+    if not os.path.isdir(CHART_CACHE_DIR):
+        return 0
+    entries = []
+    for entry in os.scandir(CHART_CACHE_DIR):
+        if entry.name.endswith('.svg'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        evicted += 1
+    return evicted
+
+# Render chart specs to SVG with the given renderer, each distinct spec once, in
+# up to `workers` processes. With cache=True charts already in CHART_CACHE_DIR are read instead
+# of rendered and new ones are added to it. Returns the SVGs in the order of
+# specs and {'charts', 'hits', 'misses', 'evicted'} counts.
+def render_charts(specs, workers=DEFAULT_WORKERS, cache=True, renderer=DEFAULT_RENDERER):
+    unique = list(dict.fromkeys(specs))
+    svgs = {}
+    if cache:
+        with profiling.span('read chart cache', charts=len(unique)):
+            keys = {spec: chart_key(spec, renderer) for spec in unique}
+            for spec in unique:
+                svg = read_chart(keys[spec])
+                if svg is not None:
+                    svgs[spec] = svg
+    missing = [spec for spec in unique if spec not in svgs]
+
+    if workers > 1 and len(missing) > 1:
+        workers = min(workers, len(missing))
+        render = partial(render_chart, renderer=renderer)
+        # With profiling on, each chart's spans are sent back with its SVG
+        if profiling.enabled():
+            render = partial(profiling.collect, render)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # A few batches per worker keeps the pool busy without a round trip per chart
+            rendered = list(pool.map(render, missing, chunksize=max(1, len(missing) // (workers * 4))))
+        if profiling.enabled():
+            for _, spans in rendered:
+                profiling.merge(spans)
+            rendered = [svg for svg, _ in rendered]
+    else:
+        rendered = [render_chart(spec, renderer) for spec in missing]
+    svgs.update(zip(missing, rendered))
+
+    evicted = 0
+    if cache:
+        with profiling.span('write chart cache', charts=len(missing)):
+            for spec, svg in zip(missing, rendered):
+                write_chart(keys[spec], svg)
+            evicted = evict_charts()
+    stats = {'charts': len(unique), 'hits': len(unique) - len(missing), 'misses': len(missing), 'evicted': evicted}
+    return [svgs[spec] for spec in specs], stats
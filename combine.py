@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+# Survey (cohort) of each language arm; both Chinese arms form one cohort
+SURVEY_ARMS = {
+    'english': 'english',
+    'spanish': 'spanish',
+    'chinese_traditional': 'chinese',
+    'chinese_simplified': 'chinese',
+}
+# Fixed category set for the survey column, so its codes are stable between runs
+SURVEY_CATEGORIES = ['english', 'spanish', 'chinese']
+
+# Index REDCap metadata once as field_name -> field_type
+def field_type_index(metadata_df):
+    return dict(zip(metadata_df['field_name'], metadata_df['field_type']))
+
+# Convert 'text' fields to numeric when every non-missing value parses as a
+# number, in one pass over all candidate columns. Empty strings count as
+# missing, as they do for pd.to_numeric.
+# Returns the updated DataFrame and the list of converted columns.
+def coerce_numeric_columns(df, field_types):
+    candidates = [col for col in df.columns if df[col].dtype == object and field_types.get(col) == 'text']
+    if not candidates:
+        return df, []
+
+    text = df[candidates]
+    numeric = text.apply(pd.to_numeric, errors='coerce')
+    present = text.notna() & text.ne('')
+    convertible = (numeric.notna() | ~present).all()
+    converted = convertible.index[convertible].tolist()
+
+    return df.assign(**{col: numeric[col] for col in converted}), converted
+
+# Columns of each arm missing from or extra to the reference column set.
+# Returns {key: (missing, extra)} for arms that differ.
+def column_mismatches(data, reference_columns):
+    reference = set(reference_columns)
+    mismatches = {}
+    for key, df in data.items():
+        missing = [col for col in reference_columns if col not in df.columns]
+        extra = [col for col in df.columns if col not in reference]
+        if missing or extra:
+            mismatches[key] = (missing, extra)
+    return mismatches
+
+# Stack the language arms into one DataFrame with the reference columns first
+# and any extra arm columns after them. The arms are concatenated block-wise in
+# one outer join, which fills columns an arm lacks with missing values without
+# reindexed per-arm copies. A categorical 'survey' column records the cohort of
+# every row.
+def combine_arms(data, reference_columns):
+    columns = list(reference_columns)
+    seen = set(columns)
+    for df in data.values():
+        columns.extend(col for col in df.columns if col not in seen and not seen.add(col))
+
+    combined = pd.concat(data.values(), ignore_index=True, sort=False)
+    # The union follows column order of appearance; only reorder when it differs
+    if list(combined.columns) != columns:
+        combined = combined[columns]
+
+    surveys = [SURVEY_ARMS.get(key, key) for key in data]
+    categories = SURVEY_CATEGORIES + [s for s in dict.fromkeys(surveys) if s not in SURVEY_CATEGORIES]
+    codes = np.repeat([categories.index(s) for s in surveys], [len(df) for df in data.values()])
+    combined['survey'] = pd.Categorical.from_codes(codes, categories=categories)
+    return combined
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import re
+
+import pandas as pd
+
+from utils import DICTIONARY_META
+
+HTML_TAG = '<[^<]+?>'
+
+# Bump when build_data_dictionary output changes for the same inputs, so
+# dictionaries built by older code are regenerated
+BUILD_VERSION = 1
+
+# One matcher for all omit patterns; a pattern matches field names that start
+# with it, with '*' removed ("consent_*" omits every consent_ field)
+def compile_omit_pattern(omit):
+    prefixes = [re.escape(pattern.replace('*', '')) for pattern in omit]
+    return re.compile('^(?:' + '|'.join(prefixes) + ')') if prefixes else None
+
+# Parse every "value, label | value, label" choice string in one pass.
+# Returns a Series aligned with `choices`: a {value: label} dict where the
+# choice string is present (empty if nothing parses) and None where it is missing.
+def parse_choices(choices):
+    present = choices.notna()
+    parts = choices[present].astype(str).str.split('|').explode().str.strip()
+    # Without any comma (or any choice string) split() returns fewer columns
+    pairs = parts.str.split(',', n=1, expand=True).reindex(columns=[0, 1]).astype(object)
+    pairs = pairs[pairs[1].notna()]
+    values = pairs[0].str.strip()
+    labels = pairs[1].str.strip().str.replace(HTML_TAG, '', regex=True)
+
+    value_labels = {index: {} for index in choices.index[present]}
+    for index, value, label in zip(values.index, values, labels):
+        value_labels[index][value] = label
+    return pd.Series([value_labels.get(index) for index in choices.index], index=choices.index, dtype=object)
+
+# Build the data dictionary from REDCap metadata. Omitted fields are dropped,
+# 'text' fields stored as numbers become 'numeric', and checkbox and
+# non-standard exploding fields list the columns they are exploded into.
+def build_data_dictionary(metadata_df, column_config, numeric_columns=()):
+    field_names = metadata_df['field_name']
+    keep = pd.Series(True, index=metadata_df.index)
+    omit_pattern = compile_omit_pattern(column_config['omit'])
+    if omit_pattern is not None:
+        keep = ~field_names.str.match(omit_pattern)
+    metadata_df = metadata_df[keep]
+    field_names = field_names[keep]
+
+    # Determine field type based on metadata and the stored column types
+    field_types = metadata_df['field_type']
+    field_types = field_types.mask((field_types == 'text') & field_names.isin(set(numeric_columns)), 'numeric')
+
+    labels = metadata_df['field_label'].fillna('').astype(str).str.replace(HTML_TAG, '', regex=True)
+    value_labels = parse_choices(metadata_df['select_choices_or_calculations'])
+    non_standard = column_config['non_standard_exploding']
+
+    data_dictionary = {}
+    for field_name, field_type, label, labels_map in zip(field_names, field_types, labels, value_labels):
+        entry = {
+            'type': field_type,
+            'label': label,
+            'value_labels': labels_map
+        }
+        # Handle non-standard exploding variables first
+        if field_name in non_standard:
+            entry['exploding'] = True
+            entry['exploded_fields'] = non_standard[field_name]
+        # Then check if it's a checkbox field (which gets "exploded")
+        elif field_type == 'checkbox':
+            entry['is_checkbox'] = True
+            if labels_map:
+                entry['exploded_fields'] = [f"{field_name}_{value}" for value in labels_map]
+        data_dictionary[field_name] = entry
+
+    return data_dictionary
+
+# Data dictionary of the combined dataset. Build errors propagate: there is no
+# usable fallback, and later steps must not type the data without a dictionary.
+def create_data_dictionary(metadata_df, column_config, combined_df):
+    numeric_columns = [col for col, dtype in combined_df.dtypes.items() if pd.api.types.is_numeric_dtype(dtype)]
+    return build_data_dictionary(metadata_df, column_config, numeric_columns)
+
+# Content hash of everything the dictionary is built from: the metadata file,
+# the column configuration and the combined schema (column names and types).
+# Unchanged inputs mean the dictionary on disk is still valid.
+def dictionary_build_hash(metadata_file, column_config_file, combined_df):
+    schema = [[col, str(dtype)] for col, dtype in combined_df.dtypes.items()]
+    parts = [f"build-version {BUILD_VERSION}".encode('utf-8'), json.dumps(schema).encode('utf-8')]
+    for path in (metadata_file, column_config_file):
+        with open(path, 'rb') as f:
+            parts.append(f.read())
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+# The build hash is stored under DICTIONARY_META, ahead of the field entries;
+# utils.read_data_dictionary separates it again
+def save_data_dictionary(path, data_dictionary, build_hash):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({DICTIONARY_META: {'build_hash': build_hash}, **data_dictionary}, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,187 @@
+#!/bin/env python3
+
+# Local stand-in for the REDCap API, for exercising 01-data_pull.py without
+# touching the real projects. Serves every raw <key> dataset / <key>_metadata.tsv pair
+# found in --source (e.g. a copy of data/raw) and prints the API_URL and
+# API_TOKEN values to put in dot.env. Editing a served <key>.tsv marks the
+# changed rows as modified, so dateRangeBegin exports can be tried out too.
+#
+# Responses are gzip-encoded for clients that accept it; --fail-rate answers a
+# share of requests with 503 to exercise the client's retries.
+#
+#   python mock_redcap.py --source /tmp/raw --port 8123 --latency 0.5
+#   python mock_redcap.py --source /tmp/raw --fail-rate 0.2
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+import pandas as pd
+
+from utils import data_file, read_data
+
+# REDCap tokens are 32 hex characters; derive a stable one from the project key
+def token_for(key):
+    return hashlib.md5(key.encode('utf-8')).hexdigest().upper()
+
+def load_projects(source):
+    projects = {}
+    for name in sorted(os.listdir(source)):
+        if not name.endswith('_metadata.tsv'):
+            continue
+        key = name[:-len('_metadata.tsv')]
+        records_file = data_file(os.path.join(source, key))
+        if records_file is None:
+            continue
+        metadata = pd.read_csv(os.path.join(source, name), sep='\t', dtype=str, keep_default_na=False)
+        metadata = metadata.drop(columns=['value_labels'], errors='ignore')
+        project = {'key': key, 'file': records_file, 'metadata': metadata, 'mtime': None,
+                   'records': None, 'modified': None, 'lock': threading.Lock()}
+        refresh_records(project)
+        projects[token_for(key)] = project
+    return projects
+
+# Reload a project's records when its file changed on disk. Rows that are new or
+# differ from the previous load get the current time as their modification time.
+def refresh_records(project):
+    with project['lock']:
+        mtime = os.path.getmtime(project['file'])
+        if mtime == project['mtime']:
+            return
+        # REDCap returns every value as a string, with '' for blanks
+        records = read_data(project['file'].rsplit('.', 1)[0], dtype=str).fillna('')
+        record_id = records.columns[0]
+        modified = pd.Series(datetime.fromtimestamp(mtime), index=records.index)
+        previous = project['records']
+        if previous is not None:
+            now = datetime.now()
+            old = previous.set_index(record_id).reindex(columns=records.columns[1:])
+            old_modified = project['modified'].set_axis(previous[record_id]).to_dict()
+            for i, row in records.iterrows():
+                rid = row[record_id]
+                unchanged = rid in old.index and old.loc[rid].fillna('').equals(row.iloc[1:])
+                modified[i] = old_modified[rid] if unchanged else now
+        project['records'], project['modified'], project['mtime'] = records, modified, mtime
+
+# Flat export column names for the requested fields; checkboxes export as
+# field___code and form status fields (<form>_complete) are always included
+def export_columns(records, fields):
+    if not fields:
+        return list(records.columns)
+    wanted = set(fields)
+    return [col for col in records.columns
+            if col in wanted or col.split('___')[0] in wanted or col.endswith('_complete')]
+
+def list_param(params, name):
+    values = []
+    i = 0
+    while f"{name}[{i}]" in params:
+        values.append(params[f"{name}[{i}]"])
+        i += 1
+    if name in params:
+        values.extend(v.strip() for v in params[name].split(','))
+    return values
+
+class RedcapHandler(BaseHTTPRequestHandler):
+    projects = {}
+    latency = 0.0
+    fail_rate = 0.0
+    # Keep connections open between requests, like a production web server
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        params = {k: v[-1] for k, v in parse_qs(body, keep_blank_values=True).items()}
+
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_rate and random.random() < self.fail_rate:
+            return self.send_text('Service Unavailable', status=503)
+
+        project = self.projects.get(params.get('token'))
+        if project is None:
+            return self.send_json({'error': 'You do not have permissions to use the API'}, status=403)
+
+        content = params.get('content')
+        if content == 'version':
+            return self.send_text('14.0.0')
+        if content == 'metadata':
+            return self.send_json(project['metadata'].to_dict(orient='records'))
+        if content == 'exportFieldNames':
+            return self.send_json(self.field_names(project))
+        if content == 'record':
+            return self.send_json(self.records(project, params))
+        return self.send_json({'error': f"Unsupported content '{content}'"}, status=400)
+
+    def field_names(self, project):
+        names = []
+        for col in project['records'].columns:
+            base, _, choice = col.partition('___')
+            names.append({'original_field_name': base, 'choice_value': choice, 'export_field_name': col})
+        return names
+
+    def records(self, project, params):
+        refresh_records(project)
+        records, modified = project['records'], project['modified']
+        ids = list_param(params, 'records')
+        if ids:
+            records = records[records[records.columns[0]].isin(ids)]
+        if params.get('dateRangeBegin'):
+            begin = datetime.strptime(params['dateRangeBegin'], '%Y-%m-%d %H:%M:%S')
+            records = records[modified[records.index] > begin]
+        if params.get('dateRangeEnd'):
+            end = datetime.strptime(params['dateRangeEnd'], '%Y-%m-%d %H:%M:%S')
+            records = records[modified[records.index] <= end]
+        columns = export_columns(records, list_param(params, 'fields'))
+        return records[columns].to_dict(orient='records')
+
+    def send_json(self, payload, status=200):
+        self.send_text(json.dumps(payload), status=status, content_type='application/json')
+
+    def send_text(self, text, status=200, content_type='text/plain'):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(source, host='127.0.0.1', port=8123, latency=0.0, fail_rate=0.0):
+    RedcapHandler.projects = load_projects(source)
+    RedcapHandler.latency = latency
+    RedcapHandler.fail_rate = fail_rate
+    server = ThreadingHTTPServer((host, port), RedcapHandler)
+    tokens = {p['key']: token for token, p in RedcapHandler.projects.items()}
+    print(f"API_URL = \"http://{host}:{server.server_port}/api/\"")
+    print(f"API_TOKEN = '{json.dumps(tokens)}'")
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve raw TSV exports through a REDCap-like API')
+    parser.add_argument('--source', default='data/raw', help='directory with raw <key> datasets and <key>_metadata.tsv files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to delay every response')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='share of requests answered with 503')
+    args = parser.parse_args()
+
+    server = serve(args.source, args.host, args.port, args.latency, args.fail_rate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,190 @@
+#!/bin/env python3
+
+# Runs the 01 -> 02 -> 03 stages in one process, make-style: a stage is skipped
+# when the content of its inputs (code included) and its arguments match its
+# last successful run and its outputs are unchanged since. A pull that reads
+# REDCap always runs. Stages that run share one typed load of the combined
+# dataset.
+#
+#   python pipeline.py                      # run what is out of date
+#   python pipeline.py validate report      # only these stages
+#   python pipeline.py --pull-args=--incremental
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import shlex
+import time
+
+from dotenv import dotenv_values
+
+from utils import CACHE_DIR, DATA_DIR, DOMAIN_MAP, RAW_DIR, data_file, load_data
+
+# The pull reads REDCap, whose state no file captures, when it refreshes
+# projects (--incremental) or when a project has no raw file yet; it then always
+# runs. Otherwise it only combines the cached raw files.
+def pull_is_volatile(argv):
+    if '--incremental' in argv:
+        return True
+    token = json.loads(dotenv_values('dot.env').get('API_TOKEN') or '{}') if os.path.exists('dot.env') else {}
+    return any(data_file(os.path.join(RAW_DIR, key)) is None for key in token)
+
+# Report files: the page, plus one script per domain and view with --split
+def report_outputs(argv):
+    return ['domain_report.html'] + (['domain_report_files'] if '--split' in argv else [])
+
+# Inputs and outputs are files or directories relative to the repository root,
+# outputs optionally a function of the stage's arguments. A dataset is named by
+# its path without extension, like data/combined. An input that is also an
+# output (the raw files the pull reads and refreshes) is recorded as the stage
+# left it. A stage whose 'volatile' check returns True for its arguments is
+# never skipped.
+COMBINED = os.path.join(DATA_DIR, 'combined')
+DATA_DICTIONARY = 'reference/data_dictionary.json'
+# Modules every stage imports
+SHARED_INPUTS = ['utils.py', 'profiling.py']
+
+STAGES = {
+    'pull': {
+        'script': '01-data_pull.py',
+        'inputs': SHARED_INPUTS + ['01-data_pull.py', 'redcap_pull.py', 'redcap_client.py', 'combine.py',
+                                   'data_dictionary.py', 'dot.env', 'reference/column_config.json', RAW_DIR],
+        'outputs': [COMBINED, DATA_DICTIONARY, RAW_DIR],
+        'volatile': pull_is_volatile,
+    },
+    'validate': {
+        'script': '02-validate.py',
+        'inputs': SHARED_INPUTS + ['02-validate.py', 'validation.py', DOMAIN_MAP, COMBINED, DATA_DICTIONARY],
+        'outputs': [os.path.join(DATA_DIR, 'validation.json')],
+    },
+    'report': {
+        'script': '03-generate_report.py',
+        'inputs': SHARED_INPUTS + ['03-generate_report.py', 'aggregate.py', 'charts.py', 'svg_charts.py',
+                                   'svg_optimize.py', 'report_cache.py', 'templates', DOMAIN_MAP,
+                                   COMBINED, DATA_DICTIONARY],
+        'outputs': report_outputs,
+    },
+}
+
+# Fingerprints of each stage's last successful run
+STATE_FILE = os.path.join(CACHE_DIR, 'pipeline.json')
+
+def resolve(path):
+    if os.path.exists(path):
+        return path
+    return data_file(path) or path
+
+# Content hash of a file, of every file under a directory, or None when missing
+def path_hash(path):
+    path = resolve(path)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    elif os.path.exists(path):
+        files = [path]
+    else:
+        return None
+    digest = hashlib.sha256()
+    for name in files:
+        digest.update(os.path.relpath(name, path).encode('utf-8'))
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def fingerprint(paths, argv=()):
+    return {'paths': {path: path_hash(path) for path in paths}, 'args': list(argv)}
+
+def read_state():
+    if not os.path.exists(STATE_FILE):
+        return {}
+    with open(STATE_FILE, encoding='utf-8') as f:
+        return json.load(f)
+
+def write_state(state):
+    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+    with open(STATE_FILE + '.part', 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(STATE_FILE + '.part', STATE_FILE)
+
+def stage_outputs(stage, argv):
+    outputs = STAGES[stage]['outputs']
+    return outputs(argv) if callable(outputs) else outputs
+
+# A stage is current when it is not volatile, its inputs, arguments and outputs
+# all match its last successful run and every output exists
+def is_current(stage, argv, state):
+    last = state.get(stage)
+    spec = STAGES[stage]
+    if last is None or spec.get('volatile', lambda argv: False)(argv):
+        return False
+    outputs = fingerprint(stage_outputs(stage, argv))
+    return (last['inputs'] == fingerprint(spec['inputs'], argv)
+            and last['outputs'] == outputs
+            and all(value is not None for value in outputs['paths'].values()))
+
+# Import a stage script by path; the scripts' names are not valid module names
+def load_stage(stage):
+    script = STAGES[stage]['script']
+    spec = importlib.util.spec_from_file_location(f"stage_{stage}", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Run the given stages (all of them by default) in pipeline order, skipping
+# current ones unless named in force. stage_args maps a stage to its argument
+# list. Returns {stage: 'skipped' | 'ran'}.
+def run_pipeline(stages=None, force=(), stage_args=None):
+    stage_args = stage_args or {}
+    state = read_state()
+    data = None
+    outcome = {}
+    for stage in STAGES:
+        if stages and stage not in stages:
+            continue
+        argv = stage_args.get(stage, [])
+        if stage not in force and is_current(stage, argv, state):
+            print(f"[{stage}] up to date, skipped")
+            outcome[stage] = 'skipped'
+            continue
+
+        print(f"[{stage}] running {STAGES[stage]['script']} {' '.join(argv)}".rstrip())
+        inputs = fingerprint(STAGES[stage]['inputs'], argv)
+        start = time.perf_counter()
+        module = load_stage(stage)
+        if stage == 'pull':
+            module.main(argv)
+            # Later stages read what this run wrote
+            data = None
+        else:
+            if data is None:
+                data = load_data()
+            module.main(argv, data=data)
+        print(f"[{stage}] finished in {time.perf_counter() - start:.1f}s")
+
+        # Recorded only after success; a failing stage raises (or exits) first
+        outputs = fingerprint(stage_outputs(stage, argv))
+        for path in inputs['paths']:
+            if path in outputs['paths']:
+                inputs['paths'][path] = outputs['paths'][path]
+        state[stage] = {'inputs': inputs, 'outputs': outputs,
+                        'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+        write_state(state)
+        outcome[stage] = 'ran'
+    return outcome
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline stages that are out of date')
+    parser.add_argument('stages', nargs='*', choices=[[]] + list(STAGES), metavar='stage',
+                        help=f"stages to consider: {', '.join(STAGES)} (default: all)")
+    parser.add_argument('--force', nargs='*', choices=list(STAGES),
+                        help='run these stages (all selected ones without names) even when up to date')
+    for stage in STAGES:
+        parser.add_argument(f'--{stage}-args', default='', help=f"arguments for {STAGES[stage]['script']}")
+    args = parser.parse_args()
+
+    selected = args.stages or list(STAGES)
+    force = selected if args.force == [] else (args.force or [])
+    stage_args = {stage: shlex.split(getattr(args, f'{stage}_args')) for stage in STAGES}
+    run_pipeline(selected, force, stage_args)
@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Summaries and traces are written here as <stage>-summary.json and
+# <stage>-trace.json (utils.DATA_DIR; utils imports this module)
+PROFILE_DIR = os.path.join('data', 'profile')
+# Slowest spans listed in a summary
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', 20))
+# Seconds between resident memory samples
+SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.01))
+
+# Resident set size of this process in bytes, from /proc where available and
+# otherwise the peak so far
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Records spans as dicts of name, labels, start and end (perf_counter seconds,
+# comparable between processes on one machine), process and thread ids and the
+# peak resident memory seen while the span was open. A sampler thread checks
+# memory every SAMPLE_INTERVAL seconds, so short peaks between samples and span
+# boundaries can be missed.
+class Profiler:
+    def __init__(self):
+        self.spans = []
+        self.open = []
+        self.samples = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while not self.stopped.is_set():
+            memory = rss()
+            with self.lock:
+                self.samples.append((time.perf_counter(), memory))
+                for span in self.open:
+                    span['peak_rss'] = max(span['peak_rss'], memory)
+            self.stopped.wait(SAMPLE_INTERVAL)
+
+    def begin(self, name, labels):
+        span = {'name': name, 'labels': labels, 'start': time.perf_counter(), 'end': None,
+                'pid': os.getpid(), 'tid': threading.get_native_id(), 'peak_rss': rss()}
+        with self.lock:
+            self.open.append(span)
+        return span
+
+    def end(self, span):
+        span['end'] = time.perf_counter()
+        memory = rss()
+        with self.lock:
+            span['peak_rss'] = max(span['peak_rss'], memory)
+            self.open.remove(span)
+            self.spans.append(span)
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+class Span:
+    def __init__(self, profiler, name, labels):
+        self.profiler = profiler
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.span = self.profiler.begin(self.name, self.labels)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.end(self.span)
+
+# Profiler of this process, None while profiling is off
+profiler = None
+# Root span of the stage being profiled
+stage_span = None
+
+def enabled():
+    return profiler is not None
+
+# Start profiling a stage; everything until export() is recorded under a root
+# span named after it
+def enable(stage):
+    global profiler, stage_span
+    if profiler is not None:
+        profiler.stop()
+    profiler = Profiler()
+    stage_span = profiler.begin(stage, {})
+
+# Timed span around a block, labeled with keyword arguments (domain, item,
+# column, cohort, ...). A no-op context while profiling is off.
+def span(name, **labels):
+    if profiler is None:
+        return nullcontext()
+    return Span(profiler, name, {key: value for key, value in labels.items() if value is not None})
+
+# Begin/end pair for spans that do not fit a with block. end(None) is a no-op,
+# so begin's result can be passed on whether or not profiling is on.
+def begin(name, **labels):
+    if profiler is None:
+        return None
+    return profiler.begin(name, {key: value for key, value in labels.items() if value is not None})
+
+def end(span):
+    if span is not None and profiler is not None:
+        profiler.end(span)
+
+# Run fn(*args, **kwargs) with a fresh profiler, for worker processes whose
+# spans would otherwise be lost. Returns (result, spans); pass the spans to
+# merge() in the parent.
+def collect(fn, *args, **kwargs):
+    global profiler
+    outer, profiler = profiler, Profiler()
+    try:
+        return fn(*args, **kwargs), profiler.spans
+    finally:
+        profiler.stop()
+        profiler = outer
+
+def merge(spans):
+    if profiler is not None:
+        with profiler.lock:
+            profiler.spans.extend(spans)
+
+# Per-name totals and the `top` slowest spans
+def summarize(spans, top=PROFILE_TOP):
+    by_name = {}
+    for span in spans:
+        seconds = span['end'] - span['start']
+        totals = by_name.setdefault(span['name'], {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        totals['count'] += 1
+        totals['seconds'] += seconds
+        totals['max_seconds'] = max(totals['max_seconds'], seconds)
+    slowest = sorted(spans, key=lambda span: span['start'] - span['end'])[:top]
+    return {
+        'spans': len(spans),
+        'peak_rss_mb': round(max((span['peak_rss'] for span in spans), default=0) / 2**20, 1),
+        'by_name': dict(sorted(by_name.items(), key=lambda item: -item[1]['seconds'])),
+        'slowest': [{'name': span['name'], 'labels': span['labels'], 'seconds': round(span['end'] - span['start'], 6),
+                     'peak_rss_mb': round(span['peak_rss'] / 2**20, 1), 'pid': span['pid']} for span in slowest],
+    }
+
+# Chrome trace (chrome://tracing, Perfetto) of the spans as complete events,
+# with this process's memory samples as a counter track
+def chrome_trace(spans, samples, origin):
+    events = [{'name': span['name'], 'cat': span['name'].split()[0], 'ph': 'X',
+               'ts': round((span['start'] - origin) * 1e6, 1), 'dur': round((span['end'] - span['start']) * 1e6, 1),
+               'pid': span['pid'], 'tid': span['tid'],
+               'args': {**{key: str(value) for key, value in span['labels'].items()},
+                        'peak_rss_mb': round(span['peak_rss'] / 2**20, 1)}}
+              for span in spans]
+    pid = os.getpid()
+    events += [{'name': 'rss', 'ph': 'C', 'ts': round((t - origin) * 1e6, 1), 'pid': pid,
+                'args': {'MB': round(memory / 2**20, 1)}} for t, memory in samples]
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+# Close the stage span, stop profiling and write <stage>-summary.json and
+# <stage>-trace.json to directory. Returns the two paths (None while profiling
+# is off).
+def export(directory=PROFILE_DIR, top=PROFILE_TOP):
+    global profiler, stage_span
+    if profiler is None:
+        return None
+    profiler.end(stage_span)
+    profiler.stop()
+    stage, spans, samples = stage_span['name'], profiler.spans, profiler.samples
+    origin, stage_end = stage_span['start'], stage_span['end']
+    profiler = stage_span = None
+
+    os.makedirs(directory, exist_ok=True)
+    summary_path = os.path.join(directory, f'{stage}-summary.json')
+    trace_path = os.path.join(directory, f'{stage}-trace.json')
+    summary = {'stage': stage, 'seconds': round(stage_end - origin, 3), **summarize(spans, top)}
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2, default=str)
+    with open(trace_path, 'w', encoding='utf-8') as f:
+        json.dump(chrome_trace(spans, samples, origin), f, default=str)
+    return summary_path, trace_path
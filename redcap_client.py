@@ -0,0 +1,237 @@
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from zoneinfo import ZoneInfo
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import profiling
+from utils import env_setting
+
+# Settings are read from the environment when a Transport is created (see
+# utils.env_setting), falling back to these defaults.
+# Attempts after the first for throttled (429), unavailable (5xx) or dropped
+# requests; override with --retries or REDCAP_RETRIES
+DEFAULT_RETRIES = 4
+# Base and cap of the exponential backoff between attempts, in seconds
+# (REDCAP_BACKOFF, REDCAP_BACKOFF_MAX)
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+# Requests per second over all projects; REDCap throttles tokens at 600 per
+# minute by default. 0 disables the limiter. Override with --rate or REDCAP_RATE.
+DEFAULT_RATE = 10.0
+# Seconds to wait for a connection and for each read of the response (REDCAP_TIMEOUT)
+CONNECT_TIMEOUT = 10
+DEFAULT_TIMEOUT = 300.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Transient failures retried like RETRY_STATUSES: no connection, no answer in
+# time, or a response body cut off or garbled on the way
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.ContentDecodingError)
+REDCAP_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class RedcapError(Exception):
+    pass
+
+# Token bucket shared by every thread: up to `rate` requests per second on
+# average, with bursts of up to `burst` requests
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until a request may be sent; returns the seconds waited
+    def acquire(self):
+        if not self.rate:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+# One pooled HTTP session for every REDCap call of a pull: connections are kept
+# alive and reused across projects and requests, responses are gzip-encoded on
+# the wire, failed requests are retried with jittered exponential backoff and a
+# shared rate limiter spaces the requests out. Every attempt is recorded in
+# `requests` as {'project', 'content', 'status', 'seconds', 'sent', 'received',
+# 'wire', 'attempt', 'error'}; 'received' counts decoded bytes and 'wire' the
+# bytes read from the socket.
+class Transport:
+    def __init__(self, pool_size=4, retries=None, rate=None, timeout=None):
+        if retries is None:
+            retries = env_setting('REDCAP_RETRIES', DEFAULT_RETRIES)
+        if rate is None:
+            rate = env_setting('REDCAP_RATE', DEFAULT_RATE, float)
+        if timeout is None:
+            timeout = (CONNECT_TIMEOUT, env_setting('REDCAP_TIMEOUT', DEFAULT_TIMEOUT, float))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        self.retries = retries
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate)
+        self.backoff_base = env_setting('REDCAP_BACKOFF', BACKOFF_BASE, float)
+        self.backoff_max = env_setting('REDCAP_BACKOFF_MAX', BACKOFF_MAX, float)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    # Full jitter: a uniform delay up to the exponential bound, or the server's
+    # Retry-After when it sent one
+    def backoff(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(self.backoff_max, float(retry_after))
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def record(self, entry):
+        with self.lock:
+            self.requests.append(entry)
+
+    # POST payload to url and return the decoded JSON response
+    def post(self, url, payload, project=None):
+        return self.request(url, payload, project)[0]
+
+    # POST payload to url and return the decoded JSON response and the
+    # response itself. REDCap errors (an 'error' key) and other client errors
+    # are raised at once; throttling, server errors and RETRY_ERRORS are retried.
+    def request(self, url, payload, project=None):
+        content = payload.get('content')
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            entry = {'project': project, 'content': content, 'status': None, 'seconds': 0.0, 'sent': 0,
+                     'received': 0, 'wire': 0, 'attempt': attempt, 'error': None}
+            start = time.perf_counter()
+            response = None
+            try:
+                with profiling.span('request', project=project, content=content, attempt=attempt):
+                    response = self.session.post(url, data=payload, timeout=self.timeout)
+                    body = response.content
+            except RETRY_ERRORS as e:
+                entry['error'] = str(e)
+                response = None
+            else:
+                entry['status'] = response.status_code
+                entry['sent'] = len(response.request.body or '')
+                entry['received'] = len(body)
+                try:
+                    entry['wire'] = response.raw.tell() or len(body)
+                except (AttributeError, OSError):
+                    entry['wire'] = len(body)
+            entry['seconds'] = time.perf_counter() - start
+            self.record(entry)
+
+            retryable = response is None or response.status_code in RETRY_STATUSES
+            if retryable and attempt < self.retries:
+                time.sleep(self.backoff(attempt, response))
+                continue
+            if response is None:
+                raise RedcapError(f"{content} request failed after {attempt + 1} attempt(s): {entry['error']}")
+
+            try:
+                result = response.json()
+            except ValueError:
+                result = None
+            if isinstance(result, dict) and 'error' in result:
+                raise RedcapError(result["error"])
+            if response.status_code != 200:
+                raise RedcapError(f"{content} request returned HTTP {response.status_code} "
+                                  f"after {attempt + 1} attempt(s)")
+            if result is None:
+                raise RedcapError(f"{content} response is not JSON")
+            return result, response
+
+    # Totals over the recorded attempts, optionally for one project
+    def stats(self, project=None):
+        with self.lock:
+            entries = [entry for entry in self.requests if project is None or entry['project'] == project]
+        latencies = sorted(entry['seconds'] for entry in entries)
+        return {
+            'requests': len(entries),
+            'retries': sum(1 for entry in entries if entry['attempt'] > 0),
+            'failed': sum(1 for entry in entries if entry['status'] != 200),
+            'sent': sum(entry['sent'] for entry in entries),
+            'received': sum(entry['received'] for entry in entries),
+            'wire': sum(entry['wire'] for entry in entries),
+            'p50': latencies[len(latencies) // 2] if latencies else 0.0,
+            'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+            'max': latencies[-1] if latencies else 0.0,
+        }
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def describe_stats(stats):
+    return (f"{stats['requests']} request(s), {stats['retries']} retried, {stats['failed']} failed; "
+            f"{stats['received'] / 2**20:.2f} MB received ({stats['wire'] / 2**20:.2f} MB on the wire), "
+            f"{stats['sent'] / 2**10:.1f} KB sent; latency p50 {stats['p50']:.2f}s, p95 {stats['p95']:.2f}s, "
+            f"max {stats['max']:.2f}s")
+
+# REDCap compares dateRangeBegin with its own local time, in the zone named by
+# REDCAP_TZ (an IANA name such as America/Los_Angeles), or this machine's zone
+# when unset
+def server_zone():
+    name = env_setting('REDCAP_TZ', None, str)
+    return ZoneInfo(name) if name else None
+
+# Naive time in the server's zone, as dateRangeBegin expects: of an aware
+# datetime when given (such as a response's Date header), otherwise now
+def server_time(moment=None):
+    moment = moment or datetime.now(timezone.utc)
+    return moment.astimezone(server_zone()).replace(tzinfo=None)
+
+# The REDCap project calls the pull makes (the subset of PyCap's Project it
+# used), over a shared Transport. date holds the server clock (aware, from the
+# Date header) of the last response, None when the server sent no Date.
+class RedcapProject:
+    def __init__(self, url, token, transport, name=None):
+        self.url = url
+        self.token = token
+        self.transport = transport
+        self.name = name
+        self.date = None
+
+    def call(self, content, **params):
+        payload = {'token': self.token, 'content': content, 'format': 'json', 'returnFormat': 'json', **params}
+        result, response = self.transport.request(self.url, payload, project=self.name)
+        try:
+            self.date = parsedate_to_datetime(response.headers['Date'])
+        except (KeyError, TypeError, ValueError):
+            self.date = None
+        return result
+
+    def export_metadata(self):
+        return self.call('metadata')
+
+    # Flat records for the given record IDs and fields (all by default),
+    # created or modified after date_begin when given
+    def export_records(self, records=None, fields=None, date_begin=None):
+        params = {'type': 'flat'}
+        for name, values in [('records', records), ('fields', fields)]:
+            for i, value in enumerate(values or []):
+                params[f'{name}[{i}]'] = value
+        if date_begin is not None:
+            params['dateRangeBegin'] = date_begin.strftime(REDCAP_DATE_FORMAT)
+        return self.call('record', **params)
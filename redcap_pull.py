@@ -0,0 +1,326 @@
+import itertools
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import profiling
+from redcap_client import RedcapError, RedcapProject, Transport, describe_stats, server_time
+from utils import DataWriter, data_columns, data_file, env_setting, iter_data, read_data
+
+# Default number of projects pulled at once; override with --workers or
+# PULL_WORKERS (read when pulling, see utils.env_setting)
+DEFAULT_WORKERS = 4
+
+# Records per export request; 0 exports each project in a single request.
+# Override with --batch-size or PULL_BATCH_SIZE (read when pulling).
+DEFAULT_BATCH_SIZE = 0
+
+# Per-project time of the last successful pull, in the REDCap server's local
+# time (see redcap_client.server_time), stored next to the raw files
+WATERMARK_FILE = 'watermarks.json'
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Watermarks come from the server's clock where it sends one; start each delta a
+# little early so any remaining skew cannot drop records. Re-fetched records are merged idempotently.
+WATERMARK_OVERLAP = timedelta(minutes=10)
+
+def strip_html(text):
+    return re.sub('<[^<]+?>', '', text)
+
+# Create a dictionary of value labels for radio, dropdown and checkbox fields
+def value_labels_from_metadata(metadata):
+    value_labels = {}
+    for field in metadata:
+        if field['field_type'] in ['radio', 'dropdown', 'checkbox']:
+            field_name = field['field_name']
+            value_labels[field_name] = {}
+            choices = field['select_choices_or_calculations'].split('|')
+            for choice in choices:
+                value, label = choice.strip().split(',', 1)
+                value_labels[field_name][value.strip()] = label.strip()
+    return value_labels
+
+# Export metadata with stripped HTML labels and save it with its value labels
+def export_metadata(project, key, raw_dir):
+    metadata = project.export_metadata()
+
+    # Strip HTML from field labels
+    for field in metadata:
+        field['field_label'] = strip_html(field['field_label'])
+
+    # Save metadata with stripped HTML and value labels
+    metadata_df = pd.DataFrame(metadata)
+    metadata_df['value_labels'] = metadata_df['field_name'].map(value_labels_from_metadata(metadata))
+    metadata_df.to_csv(os.path.join(raw_dir, f"{key}_metadata.tsv"), index=False, sep='\t')
+
+    return [field['field_name'] for field in metadata]
+
+# Export metadata and records for a single project and save them to raw_dir.
+# With `since`, only records created or modified after that time are exported
+# and merged by record ID into the existing raw file. With `batch_size`, records
+# are exported in chunks of that many record IDs and streamed to disk, so the
+# project is never held in memory; the returned DataFrame is then None. Without
+# a batch_size, PULL_BATCH_SIZE applies.
+# Requests go through transport, shared by the projects of a pull (a
+# single-connection one, closed afterwards, by default).
+# Returns the records DataFrame, the time spent in each phase and the pull time
+# (the next watermark, in the server's local time).
+def pull_project(key, api_url, api_key, raw_dir, since=None, batch_size=None, tsv=False, transport=None):
+    if batch_size is None:
+        batch_size = env_setting('PULL_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    if transport is None:
+        with Transport(pool_size=1) as transport:
+            return pull_project(key, api_url, api_key, raw_dir, since, batch_size, tsv, transport)
+    timings = {}
+    start = time.perf_counter()
+    project = RedcapProject(api_url, api_key, transport, name=key)
+
+    # Get metadata
+    with profiling.span('export metadata', project=key):
+        field_names = export_metadata(project, key, raw_dir)
+    timings['metadata'] = time.perf_counter() - start
+    # The watermark is taken before any record is exported, on the server's
+    # clock and in its zone, as the next dateRangeBegin is compared with them
+    pulled_at = server_time(project.date)
+
+    raw_base = os.path.join(raw_dir, key)
+    record_id = field_names[0]
+
+    if batch_size:
+        # Export and save are interleaved, so all of it is counted as records time
+        phase_start = time.perf_counter()
+        with profiling.span('export records', project=key, batch_size=batch_size):
+            ids = export_record_ids(project, record_id, since)
+            batches = iter_record_batches(project, field_names, ids, batch_size)
+            if since is None:
+                timings['rows'] = write_batches(raw_base, batches, tsv)
+            else:
+                # The delta is proportional to the changes; the cached file is streamed
+                delta = pd.concat(batches, ignore_index=True).replace('', None) if ids else pd.DataFrame()
+                timings['rows'] = len(delta)
+                merge_records_streaming(raw_base, delta, record_id, batch_size, tsv)
+        timings['records'] = time.perf_counter() - phase_start
+        timings['save'] = 0.0
+        timings['total'] = time.perf_counter() - start
+        return None, timings, pulled_at
+
+    # Export records with specific fields
+    phase_start = time.perf_counter()
+    with profiling.span('export records', project=key):
+        # Blanks become missing values here, so a fresh pull returns what a
+        # later run reads back from the raw file
+        df = pd.DataFrame(project.export_records(fields=field_names, date_begin=since)).replace('', None)
+    timings['records'] = time.perf_counter() - phase_start
+    timings['rows'] = len(df)
+
+    # Save data
+    phase_start = time.perf_counter()
+    with profiling.span('save records', project=key):
+        if since is not None:
+            df = merge_records(read_data(raw_base, dtype=str), df, record_id)
+        write_raw(df, raw_base, tsv)
+    timings['save'] = time.perf_counter() - phase_start
+
+    timings['total'] = time.perf_counter() - start
+    return df, timings, pulled_at
+
+# Record IDs to export, from a cheap export of the record ID field alone
+def export_record_ids(project, record_id, since=None):
+    ids = [row[record_id] for row in project.export_records(fields=[record_id], date_begin=since)]
+    # Repeating instruments list a record once per instance
+    return list(dict.fromkeys(ids))
+
+# Export records in chunks of batch_size record IDs
+def iter_record_batches(project, field_names, ids, batch_size):
+    for i in range(0, len(ids), batch_size):
+        yield pd.DataFrame(project.export_records(records=ids[i:i + batch_size], fields=field_names))
+
+# Raw exports are stored as strings, with blanks as missing values (already
+# replaced by pull_project)
+def write_raw(df, raw_base, tsv=False):
+    with DataWriter(raw_base, df.columns, tsv=tsv, strings=True) as writer:
+        writer.write(df)
+
+# Stream batches to the raw store. The first batch fixes the header and column
+# order; later batches are aligned to it.
+def write_batches(raw_base, batches, tsv=False):
+    batches = iter(batches)
+    first = next(batches, pd.DataFrame())
+    rows = 0
+    with DataWriter(raw_base, first.columns, tsv=tsv, strings=True) as writer:
+        for batch in itertools.chain([first], batches):
+            extra = [col for col in batch.columns if col not in writer.header]
+            if extra:
+                print(f"Warning: dropping columns not in the first batch of {os.path.basename(raw_base)}: {extra}")
+            writer.write(batch.replace('', None))
+            rows += len(batch)
+    return rows
+
+# REDCap exports one row per record, event and repeating instrument instance;
+# these columns are present only when the project uses events or repeats
+ROW_KEY_COLUMNS = ['redcap_event_name', 'redcap_repeat_instrument', 'redcap_repeat_instance']
+
+# Row identities of an export: the record ID plus whichever of ROW_KEY_COLUMNS
+# it has, with blanks as ''
+def row_keys(df, record_id):
+    keys = [record_id] + [col for col in ROW_KEY_COLUMNS if col in df.columns]
+    return pd.MultiIndex.from_frame(df[keys].fillna('').astype(str))
+
+# Replace cached rows by row identity (see row_keys) with their changed versions
+# and append new rows, keeping the cached row order. Records deleted in REDCap
+# are not reported by a date-range export; remove the raw file to force a full
+# pull.
+def merge_records(cached, delta, record_id):
+    if delta.empty:
+        return cached
+    columns = list(cached.columns) + [col for col in delta.columns if col not in cached.columns]
+    delta_keys = row_keys(delta, record_id)
+    delta = delta[~delta_keys.duplicated(keep='last')].reindex(columns=columns)
+    delta_keys = row_keys(delta, record_id)
+    # Raw exports are strings; columns new in the delta must be able to hold them
+    merged = cached.reindex(columns=columns).astype(object)
+    cached_keys = row_keys(merged, record_id)
+    positions = delta_keys.get_indexer(cached_keys)
+    changed = positions >= 0
+    merged.loc[changed] = delta.iloc[positions[changed]].to_numpy()
+    new = ~delta_keys.isin(cached_keys)
+    return pd.concat([merged, delta[new]], ignore_index=True)
+
+# Streaming counterpart of merge_records: the cached raw data is read and
+# rewritten chunk by chunk, with changed rows replaced in place and new rows
+# appended.
+def merge_records_streaming(raw_base, delta, record_id, chunksize, tsv=False):
+    if delta.empty:
+        return
+    delta = delta[~row_keys(delta, record_id).duplicated(keep='last')]
+    chunks = iter_data(raw_base, chunksize)
+    # A project cached without records yet has a header but no chunks
+    first = next(chunks, None)
+    if first is None:
+        first = pd.DataFrame(columns=data_columns(raw_base))
+    header = list(first.columns) + [col for col in delta.columns if col not in first.columns]
+    delta = delta.reindex(columns=header)
+    delta_keys = row_keys(delta, record_id)
+    seen = pd.Series(False, index=range(len(delta)))
+    # The writer only replaces the cached file once every chunk has been read
+    with DataWriter(raw_base, header, tsv=tsv, strings=True) as writer:
+        for chunk in itertools.chain([first], chunks):
+            chunk = chunk.reindex(columns=header).astype(object)
+            positions = delta_keys.get_indexer(row_keys(chunk, record_id))
+            changed = positions >= 0
+            if changed.any():
+                seen.iloc[positions[changed]] = True
+                chunk.loc[changed] = delta.iloc[positions[changed]].to_numpy()
+            writer.write(chunk)
+        writer.write(delta[~seen.to_numpy()])
+
+def load_watermarks(raw_dir):
+    watermark_file = os.path.join(raw_dir, WATERMARK_FILE)
+    if not os.path.exists(watermark_file):
+        return {}
+    with open(watermark_file, 'r', encoding='utf-8') as f:
+        return {key: datetime.strptime(value, WATERMARK_FORMAT) for key, value in json.load(f).items()}
+
+def save_watermarks(raw_dir, watermarks):
+    with open(os.path.join(raw_dir, WATERMARK_FILE), 'w', encoding='utf-8') as f:
+        json.dump({key: value.strftime(WATERMARK_FORMAT) for key, value in watermarks.items()}, f, indent=2)
+
+# Load cached raw files and pull the remaining projects concurrently over one
+# pooled Transport (see redcap_client.py).
+# In incremental mode cached projects are refreshed with the records changed
+# since their watermark instead of being reused as-is.
+# A project that still fails after its retries stops the pull with RedcapError,
+# so no cohort is silently left out of the combined dataset. With
+# allow_partial=True the pull goes on without it (or with its cached raw file,
+# when there is one) after a warning.
+# workers, batch_size, retries and rate default to their environment settings
+# (None).
+# Returns {key: DataFrame} in token order and {key: timings} for pulled projects.
+def pull_projects(token, api_url, raw_dir, workers=None, incremental=False,
+                  batch_size=None, tsv=False, allow_partial=False,
+                  retries=None, rate=None):
+    if workers is None:
+        workers = env_setting('PULL_WORKERS', DEFAULT_WORKERS)
+    if batch_size is None:
+        batch_size = env_setting('PULL_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    data = {}
+    timings = {}
+    to_pull = []
+    watermarks = load_watermarks(raw_dir)
+    since = {}
+
+    # Check if raw files exist; if not, download from REDCap
+    for key in token:
+        raw_file = data_file(os.path.join(raw_dir, key))
+        if raw_file and incremental:
+            # Without a watermark the project is pulled in full once to establish one
+            if key in watermarks:
+                since[key] = watermarks[key] - WATERMARK_OVERLAP
+            to_pull.append(key)
+        elif raw_file:
+            with profiling.span('read raw', project=key):
+                data[key] = read_data(os.path.join(raw_dir, key))
+            print(f"Loaded: {os.path.basename(raw_file)}")
+        else:
+            to_pull.append(key)
+
+    if to_pull:
+        workers = max(1, min(workers, len(to_pull)))
+        print(f"Pulling {len(to_pull)} project(s) with {workers} worker(s)")
+        start = time.perf_counter()
+        failed = {}
+        with Transport(pool_size=workers, retries=retries, rate=rate) as transport, \
+                ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(pull_project, key, api_url, token[key], raw_dir, since.get(key), batch_size, tsv,
+                            transport): key
+                for key in to_pull
+            }
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    data[key], timings[key], watermarks[key] = future.result()
+                    timings[key]['requests'] = transport.stats(key)
+                    print(f"Saved: {key}_metadata.tsv")
+                    raw_name = os.path.basename(data_file(os.path.join(raw_dir, key)))
+                    if key in since:
+                        print(f"Merged {timings[key]['rows']} changed record(s) into {raw_name}")
+                    else:
+                        print(f"Saved: {raw_name}")
+                except Exception as e:
+                    print(f"Error: {key}: {e}")
+                    failed[key] = e
+            print(f"REDCap API: {describe_stats(transport.stats())}")
+        # Watermarks of the projects that were pulled are kept either way
+        save_watermarks(raw_dir, watermarks)
+
+        if failed and not allow_partial:
+            raise RedcapError(f"Pull failed for {', '.join(failed)}; rerun, or allow a partial pull to continue without them")
+        for key in failed:
+            raw_file = data_file(os.path.join(raw_dir, key))
+            if raw_file:
+                data[key] = read_data(os.path.join(raw_dir, key))
+                print(f"Warning: {key} could not be refreshed; using the cached {os.path.basename(raw_file)}")
+            else:
+                print(f"Warning: {key} could not be pulled and is left out of the combined dataset")
+
+        # Batched pulls stream straight to disk; load them once all exports are done
+        for key in to_pull:
+            if key in data and data[key] is None:
+                data[key] = read_data(os.path.join(raw_dir, key))
+        report_timings(timings)
+        print(f"Pull finished in {time.perf_counter() - start:.2f}s")
+
+    # Keep token order so the combined file is stable between runs
+    return {key: data[key] for key in token if key in data}, timings
+
+def report_timings(timings):
+    for key, t in timings.items():
+        print(f"Pulled {key} ({t['rows']} records) in {t['total']:.2f}s "
+              f"(metadata {t['metadata']:.2f}s, records {t['records']:.2f}s, save {t['save']:.2f}s)")
+        if 'requests' in t:
+            print(f"  {describe_stats(t['requests'])}")
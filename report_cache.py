@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import pickle
+
+import pandas as pd
+
+from charts import CHART_STYLE_VERSION
+from utils import CACHE_DIR
+
+# Built report entries (the template context of one domain_map row, charts
+# included) are cached as <fingerprint>.pkl
+REPORT_CACHE_DIR = os.path.join(CACHE_DIR, 'report')
+# Bump when 03-generate_report.py builds entries differently, so cached entries
+# are rebuilt
+ENTRY_VERSION = 1
+
+# Content hash of a column's values and type
+def column_hash(series):
+    values = pd.util.hash_pandas_object(series, index=False).to_numpy()
+    return hashlib.sha256(str(series.dtype).encode('utf-8') + values.tobytes()).hexdigest()
+
+# Fingerprint of everything a report entry is built from: its domain_map row,
+# the data and dictionary entries of its columns (checkbox parents and their
+# exploded columns), the cohort of every row, the chart renderer and the entry
+# and chart style versions. column_hashes maps column -> column_hash and is
+# filled as columns are first seen, so a column shared by entries is hashed once.
+def entry_fingerprint(row, related_columns, data, data_dictionary, cohort_var, renderer, column_hashes):
+    def hashed(col):
+        if col not in column_hashes:
+            column_hashes[col] = column_hash(data[col]) if col in data.columns else None
+        return column_hashes[col]
+
+    content = [
+        ENTRY_VERSION, CHART_STYLE_VERSION, renderer, row,
+        hashed(cohort_var),
+        [[parent, data_dictionary.get(parent), [[col, data_dictionary.get(col), hashed(col)] for col in children]]
+         for parent, children in related_columns.items()],
+    ]
+    encoded = json.dumps(content, default=str, sort_keys=True)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+def entry_path(fingerprint):
+    return os.path.join(REPORT_CACHE_DIR, fingerprint + '.pkl')
+
+def read_entry(fingerprint):
+    try:
+        with open(entry_path(fingerprint), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_entry(fingerprint, entry):
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    path = entry_path(fingerprint)
+    with open(path + '.part', 'wb') as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.part', path)
+
+# Remove cached entries whose fingerprint is not in keep (entries of rows that
+# changed or left the domain map). Returns the number removed.
+def evict_entries(keep):
+    if not os.path.isdir(REPORT_CACHE_DIR):
+        return 0
+    evicted = 0
+    for name in os.listdir(REPORT_CACHE_DIR):
+        if name.endswith('.pkl') and name[:-len('.pkl')] not in keep:
+            os.remove(os.path.join(REPORT_CACHE_DIR, name))
+            evicted += 1
+    return evicted
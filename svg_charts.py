@@ -0,0 +1,133 @@
+import math
+from html import escape
+
+import pandas as pd
+
+# Minimal SVG writer for the two report charts. Layout follows the matplotlib
+# charts of charts.py (10in wide figures, skyblue bars, count labels, ticks
+# rotated 45 degrees) in points, so the charts are drawn at the same size.
+WIDTH = 720
+HEIGHT = 432
+MARGIN = {'left': 60, 'right': 18, 'top': 36, 'bottom': 48}
+FONT = 'font-family="DejaVu Sans, Arial, sans-serif"'
+BAR_COLOR = '#87ceeb'
+# Approximate width of a 10pt character, to make room for rotated labels
+CHAR_WIDTH = 6
+
+# Round tick positions covering [low, high], about `count` of them
+def nice_ticks(low, high, count=6):
+    span = high - low
+    if span <= 0:
+        return [low]
+    raw = span / count
+    magnitude = 10 ** math.floor(math.log10(raw))
+    step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw)
+    first = math.ceil(low / step - 1e-9)
+    return [(first + i) * step for i in range(int(math.floor(high / step + 1e-9)) - first + 1)]
+
+def tick_label(value, ticks):
+    step = ticks[1] - ticks[0] if len(ticks) > 1 else 1
+    decimals = 0
+    while decimals < 6 and abs(round(step, decimals) - step) > 1e-9 * max(1, abs(step)):
+        decimals += 1
+    return f'{value:.{decimals}f}'
+
+def text(x, y, content, size=10, anchor='middle', rotate=None, baseline=None):
+    transform = f' transform="rotate({rotate} {x:.1f} {y:.1f})"' if rotate is not None else ''
+    dominant = f' dominant-baseline="{baseline}"' if baseline else ''
+    return (f'<text x="{x:.1f}" y="{y:.1f}" font-size="{size}" text-anchor="{anchor}"{dominant}{transform}>'
+            f'{escape(str(content))}</text>')
+
+# Frame, ticks, tick labels, axis labels and title around the plot area.
+# x_ticks are (position, label) pairs in SVG coordinates; y ticks are values
+# mapped with to_y. The x axis label is centred at height xlabel_y.
+def axes(box, x_ticks, y_ticks, to_y, xlabel, ylabel, title, xlabel_y, rotate_x=False):
+    left, top, right, bottom = box
+    parts = [f'<rect x="{left:.1f}" y="{top:.1f}" width="{right - left:.1f}" height="{bottom - top:.1f}" '
+             f'fill="none" stroke="#000" stroke-width="0.8"/>']
+    for x, label in x_ticks:
+        parts.append(f'<line x1="{x:.1f}" y1="{bottom:.1f}" x2="{x:.1f}" y2="{bottom + 3.5:.1f}" stroke="#000" stroke-width="0.8"/>')
+        if rotate_x:
+            parts.append(text(x, bottom + 12, label, anchor='end', rotate=-45))
+        else:
+            parts.append(text(x, bottom + 15, label))
+    for value in y_ticks:
+        y = to_y(value)
+        parts.append(f'<line x1="{left - 3.5:.1f}" y1="{y:.1f}" x2="{left:.1f}" y2="{y:.1f}" stroke="#000" stroke-width="0.8"/>')
+        parts.append(text(left - 6, y, tick_label(value, y_ticks), anchor='end', baseline='middle'))
+    label_offset = max((len(tick_label(value, y_ticks)) for value in y_ticks), default=1) * CHAR_WIDTH
+    parts.append(text(left - label_offset - 16, (top + bottom) / 2, ylabel, anchor='middle', rotate=-90))
+    parts.append(text((left + right) / 2, xlabel_y, xlabel))
+    parts.append(text((left + right) / 2, top - 10, title, size=12))
+    return parts
+
+def document(width, height, parts):
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}pt" height="{height:.0f}pt" '
+            f'viewBox="0 0 {width:.0f} {height:.0f}" {FONT}>'
+            f'<rect width="100%" height="100%" fill="#fff"/>' + ''.join(parts) + '</svg>')
+
+# Same arguments and placeholder strings as charts.generate_bar_chart
+def svg_bar_chart(labels, counts, title, cohort=None, max_count=None):
+    if not counts:
+        return "No data to plot."
+
+    valid_data = [(label, count) for label, count in zip(labels, counts) if pd.notna(label) and label != 'nan']
+
+    if not valid_data:
+        return "No valid data to plot."
+
+    valid_labels = [str(label) for label, _ in valid_data]
+    valid_counts = [int(count) for _, count in valid_data]
+
+    # Plot height grows with the number of bars like the matplotlib figure, and
+    # the rotated labels get the room they need below it
+    plot_height = max(HEIGHT, len(valid_labels) * 0.4 * 72) - MARGIN['top'] - MARGIN['bottom']
+    label_room = max(len(label) for label in valid_labels) * CHAR_WIDTH * 0.71 + 12
+    left, top, right = MARGIN['left'], MARGIN['top'], WIDTH - MARGIN['right']
+    bottom = top + plot_height
+    height = bottom + label_room + 24
+
+    # Bars of width 0.8 at 0..n-1 with 5% margins, y from 0 to 110% of the tallest
+    n = len(valid_counts)
+    x_low, x_high = -0.4, n - 0.6
+    pad = (x_high - x_low) * 0.05
+    x_low, x_high = x_low - pad, x_high + pad
+    y_high = max(valid_counts) * 1.1 or 1
+    to_x = lambda v: left + (v - x_low) / (x_high - x_low) * (right - left)
+    to_y = lambda v: bottom - v / y_high * (bottom - top)
+
+    parts = []
+    for i, count in enumerate(valid_counts):
+        x0, x1, y = to_x(i - 0.4), to_x(i + 0.4), to_y(count)
+        parts.append(f'<rect x="{x0:.1f}" y="{y:.1f}" width="{x1 - x0:.1f}" height="{bottom - y:.1f}" fill="{BAR_COLOR}"/>')
+        parts.append(text((x0 + x1) / 2, y - 3, count))
+    y_ticks = [v for v in nice_ticks(0, y_high) if v <= y_high]
+    parts += axes((left, top, right, bottom), [(to_x(i), label) for i, label in enumerate(valid_labels)],
+                  y_ticks, to_y, 'Options', 'Counts', f'{title}' + (f' ({cohort})' if cohort else ''),
+                  height - 8, rotate_x=True)
+    return document(WIDTH, height, parts)
+
+# Same arguments as charts.generate_histogram: bin counts and edges
+def svg_histogram(counts, edges, column, cohort=None):
+    left, top, right = MARGIN['left'], MARGIN['top'], WIDTH - MARGIN['right']
+    bottom = HEIGHT - MARGIN['bottom']
+
+    # Bins span the edges with 5% margins; y from 0 to 105% of the tallest bin
+    pad = (edges[-1] - edges[0]) * 0.05 or 0.5
+    x_low, x_high = edges[0] - pad, edges[-1] + pad
+    y_high = max(counts) * 1.05 or 1
+    to_x = lambda v: left + (v - x_low) / (x_high - x_low) * (right - left)
+    to_y = lambda v: bottom - v / y_high * (bottom - top)
+
+    parts = []
+    for count, x0, x1 in zip(counts, edges[:-1], edges[1:]):
+        if count:
+            y = to_y(count)
+            parts.append(f'<rect x="{to_x(x0):.1f}" y="{y:.1f}" width="{to_x(x1) - to_x(x0):.1f}" height="{bottom - y:.1f}" '
+                         f'fill="{BAR_COLOR}" fill-opacity="0.75" stroke="#000" stroke-width="0.5"/>')
+    x_values = [v for v in nice_ticks(x_low, x_high) if x_low <= v <= x_high]
+    y_ticks = [v for v in nice_ticks(0, y_high) if v <= y_high]
+    parts += axes((left, top, right, bottom), [(to_x(v), tick_label(v, x_values)) for v in x_values],
+                  y_ticks, to_y, 'Values', 'Frequency', f'Distribution of {column}' + (f' ({cohort})' if cohort else ''),
+                  HEIGHT - 10)
+    return document(WIDTH, HEIGHT, parts)
@@ -0,0 +1,104 @@
+import gzip
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Default number of decimals kept in chart coordinates (points; 0.01pt is far
+# below a screen pixel)
+DEFAULT_PRECISION = 2
+# Suffixes of the precompressed copies written by write_compressed
+COMPRESSED_EXTENSIONS = ('.gz', '.br')
+
+PROLOGUE = re.compile(r'<\?xml[^>]*\?>|<!DOCTYPE[^>]*>|<metadata>.*?</metadata>|<!--.*?-->', re.S)
+DEFS = re.compile(r'<defs>(.*?)</defs>', re.S)
+# Definitions inside <defs>: self-closing elements and clip paths with an id, and style blocks
+DEFINITION = re.compile(r'<(\w+) id="([^"]+)"[^>]*/>|<clipPath id="([^"]+)">.*?</clipPath>|<style[^>]*>.*?</style>', re.S)
+# Attributes holding coordinates; transforms only have their translations rounded,
+# as glyph scales need every digit
+COORDINATES = re.compile(r' (d|x|y|x1|y1|x2|y2|width|height|points|transform)="([^"]*)"')
+TRANSLATE = re.compile(r'translate\(([^)]*)\)')
+NUMBER = re.compile(r'-?\d+\.\d+')
+
+def round_numbers(text, precision):
+    def shorten(match):
+        value = f'{float(match.group()):.{precision}f}'.rstrip('0').rstrip('.')
+        return '0' if value == '-0' else value
+    return NUMBER.sub(shorten, text)
+
+def round_coordinates(svg, precision):
+    def attribute(match):
+        name, value = match.groups()
+        if name == 'transform':
+            value = TRANSLATE.sub(lambda m: f'translate({round_numbers(m.group(1), precision)})', value)
+        else:
+            value = round_numbers(' '.join(value.split()), precision)
+        return f' {name}="{value}"'
+    return COORDINATES.sub(attribute, svg)
+
+# Optimize rendered charts for inlining into one HTML document: strip the XML
+# prologue, metadata and comments, round coordinates to `precision` decimals and
+# move every <defs> definition (glyphs, markers, clip paths, styles) into one
+# shared <defs> block. matplotlib ids are content hashes (see charts.py), so an
+# id names the same definition in every chart and each is kept once.
+# Returns the optimized charts, in order, and the shared block to place once in
+# the document; strings that are not SVG are returned unchanged.
+def optimize_svgs(svgs, precision=DEFAULT_PRECISION):
+    shared = {}
+
+    def hoist(match):
+        for definition in DEFINITION.finditer(match.group(1)):
+            key = definition.group(2) or definition.group(3) or definition.group()
+            shared.setdefault(key, definition.group())
+        # Anything else stays in the chart
+        rest = DEFINITION.sub('', match.group(1))
+        return f'<defs>{rest}</defs>' if rest.strip() else ''
+
+    optimized = []
+    for svg in svgs:
+        if not svg.lstrip().startswith('<'):
+            optimized.append(svg)
+            continue
+        svg = PROLOGUE.sub('', svg)
+        svg = DEFS.sub(hoist, svg)
+        svg = round_coordinates(svg, precision)
+        optimized.append(re.sub(r'>\s+<', '><', svg).strip())
+
+    if not shared:
+        return optimized, ''
+    definitions = round_coordinates(''.join(shared.values()), precision)
+    definitions = re.sub(r'>\s+<', '><', definitions)
+    # Zero-sized rather than display:none, which would disable the clip paths
+    block = ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+             'width="0" height="0" style="position: absolute" aria-hidden="true">'
+             f'<defs>{definitions}</defs></svg>')
+    return optimized, block
+
+# Write gzip and, with the brotli package, brotli compressed copies next to path
+# for servers that serve precompressed files. Returns {extension: bytes}.
+def write_compressed(path):
+    with open(path, 'rb') as f:
+        content = f.read()
+    sizes = {}
+    compressors = {'.gz': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressors['.br'] = lambda data: brotli.compress(data, quality=11)
+    for extension, compress in compressors.items():
+        compressed = compress(content)
+        with open(path + extension, 'wb') as f:
+            f.write(compressed)
+        sizes[extension] = len(compressed)
+    return sizes
+
+# Remove compressed copies of path written by write_compressed
+def remove_compressed(path):
+    for extension in COMPRESSED_EXTENSIONS:
+        if os.path.exists(path + extension):
+            os.remove(path + extension)
+
+def describe_sizes(path, sizes):
+    compressed = ', '.join(f"{extension} {size:,} bytes" for extension, size in sizes.items())
+    return f"{os.path.basename(path)}: {os.path.getsize(path):,} bytes ({compressed})"
@@ -0,0 +1,263 @@
+#!/bin/env python3
+
+# Synthetic respondents for trying the pipeline at scale without the REDCap
+# projects. Columns and codes come from reference/data_dictionary.json and
+# reference/column_config.json; answers are drawn from per-field distributions
+# that differ by cohort. The output directory is laid out like the repository
+# (data/combined, reference/, templates/), so the stages and benchmark.py can
+# be run from it.
+#
+#   python synthetic.py --output /tmp/synthetic --rows 100000
+#   python synthetic.py --output /tmp/synthetic --rows 1000000 --cohorts english=2 spanish=1 chinese=1
+
+import argparse
+import json
+import os
+import re
+import shutil
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from combine import SURVEY_CATEGORIES
+from utils import (COHORT_COLUMN, DATA_DIR, DOMAIN_MAP, STRING_DTYPE, DataWriter, compact_numeric, compile_dtypes,
+                   convert_column, read_data_dictionary)
+
+# Rows generated and written at a time
+DEFAULT_CHUNKSIZE = 50000
+# Field holding the respondent's age; grid columns of life periods the
+# respondent has not reached are left blank
+AGE_FIELD = 'msoc_age'
+# Grid column suffixes of the life periods and the age each period starts at
+PERIOD_STARTS = {'0': 0, '11': 11, '25': 25, '35': 35, '46': 46, '66': 66, 'rec': 0}
+# Distinct answers of each free-text field
+TEXT_POOL_SIZE = 50
+# Code written for out-of-range answers (see --invalid-rate)
+INVALID_CODE = 99
+# Copied into the output directory next to the generated dataset
+REFERENCE_FILES = ['reference/data_dictionary.json', 'reference/column_config.json', DOMAIN_MAP]
+
+# Random generator of one field (and cohort), independent of generation order
+def field_rng(seed, *names):
+    return np.random.default_rng([seed] + [zlib.crc32(name.encode('utf-8')) for name in names])
+
+# 'cohort=weight' arguments as {cohort: weight}
+def parse_mix(values):
+    mix = {}
+    for value in values:
+        cohort, _, weight = value.partition('=')
+        mix[cohort] = float(weight or 1)
+    return mix
+
+# Rows per cohort for the mix, summing to rows (largest remainders get the
+# leftover rows)
+def cohort_sizes(rows, mix):
+    total = sum(mix.values())
+    shares = {cohort: rows * weight / total for cohort, weight in mix.items()}
+    sizes = {cohort: int(share) for cohort, share in shares.items()}
+    for cohort in sorted(shares, key=lambda c: sizes[c] - shares[c])[:rows - sum(sizes.values())]:
+        sizes[cohort] += 1
+    return sizes
+
+# Fields whose answer is piped into an option label ("Other: {field}") are only
+# answered when that option is chosen. Returns {field: (column, value)}, with
+# value True for checkbox options.
+def piped_fields(data_dictionary):
+    gates = {}
+    for field, info in data_dictionary.items():
+        for code, label in (info.get('value_labels') or {}).items():
+            for piped in re.findall(r'\{(\w+)\}', str(label)):
+                if piped in data_dictionary:
+                    gates[piped] = (f'{field}_{code}', True) if info.get('is_checkbox') else (field, code)
+    return gates
+
+# Generation model of every dataset column, in dataset order. Each model is a
+# dict with the column's 'kind', its storage dtype and its per-cohort
+# parameters; checkbox children share one 'checkbox' model under the parent.
+def column_models(data_dictionary, column_config, cohorts, seed, invalid_rate=0.0):
+    dtypes = compile_dtypes(data_dictionary)
+    gates = piped_fields(data_dictionary)
+    # Grid columns without a dictionary entry are generated like a sibling that has one
+    grids = dict(column_config.get('non_standard_exploding', {}))
+    grids.update({field: info['exploded_fields'] for field, info in data_dictionary.items()
+                  if info.get('exploding') and 'exploded_fields' in info})
+    siblings = {column: next((c for c in members if c in data_dictionary), None)
+                for members in grids.values() for column in members if column not in data_dictionary}
+    grid_columns = {column for members in grids.values() for column in members}
+
+    record_id = next(iter(data_dictionary))
+
+    # Piped option as (column, value) in the column's stored type
+    def gate(column):
+        if column not in gates:
+            return None
+        parent, value = gates[column]
+        if isinstance(dtypes.get(parent), pd.CategoricalDtype) and pd.api.types.is_integer_dtype(dtypes[parent].categories):
+            value = int(value)
+        return parent, value
+
+    def model(column, info):
+        rng = field_rng(seed, column)
+        field_type = info['type']
+        missing = {cohort: field_rng(seed, column, cohort, 'missing').beta(1.5, 8) for cohort in cohorts}
+        entry = {'missing': missing, 'gate': gate(column), 'period': None}
+        if column in grid_columns:
+            suffix = re.search(r'(\d+|rec)$', column)
+            entry['period'] = PERIOD_STARTS.get(suffix.group(1)) if suffix else None
+        if field_type in ('radio', 'dropdown') and len(getattr(dtypes.get(column), 'categories', [])):
+            categories = list(dtypes[column].categories)
+            base = rng.dirichlet(np.full(len(categories), 1.5))
+            # Cohorts lean the shared distribution their own way
+            probs = {}
+            for cohort in cohorts:
+                leaning = base * field_rng(seed, column, cohort).lognormal(0, 0.5, len(categories))
+                probs[cohort] = leaning / leaning.sum()
+            invalid = [INVALID_CODE if pd.api.types.is_integer_dtype(dtypes[column].categories) else str(INVALID_CODE)]
+            dtype = pd.CategoricalDtype(categories + invalid) if invalid_rate else dtypes[column]
+            entry.update(kind='choice', dtype=dtype, probs=probs, invalid_rate=invalid_rate)
+        elif field_type in ('yesno', 'truefalse'):
+            entry.update(kind='boolean', dtype='boolean', probs={cohort: rng.beta(2, 2) for cohort in cohorts})
+        elif field_type in ('text', 'notes'):
+            weights = 1 / np.arange(1, TEXT_POOL_SIZE + 1)
+            entry.update(kind='text', dtype=STRING_DTYPE, pool=[f'{column} answer {i + 1}' for i in range(TEXT_POOL_SIZE)],
+                         probs=weights / weights.sum())
+        elif column == AGE_FIELD:
+            means = {cohort: field_rng(seed, column, cohort).uniform(35, 55) for cohort in cohorts}
+            entry.update(kind='age', dtype=compact_numeric(pd.Series([18, 95])).dtype, means=means)
+        else:
+            # Counts, years and hours: small non-negative integers
+            entry.update(kind='number', dtype=compact_numeric(pd.Series([0, 99])).dtype,
+                         lam={cohort: field_rng(seed, column, cohort).uniform(1, 6) for cohort in cohorts})
+        return entry
+
+    models = {record_id: {'kind': 'id', 'dtype': dtypes.get(record_id, 'Int64'), 'gate': None}}
+    for field, info in data_dictionary.items():
+        if field == record_id:
+            continue
+        if info.get('is_checkbox'):
+            rng = field_rng(seed, field)
+            columns = info.get('exploded_fields', [])
+            models[field] = {
+                'kind': 'checkbox', 'columns': columns, 'gate': gate(field),
+                'missing': {cohort: field_rng(seed, field, cohort, 'missing').beta(1.5, 8) for cohort in cohorts},
+                'probs': {cohort: rng.beta(1.2, 3, len(columns)) for cohort in cohorts},
+            }
+        elif info['type'] == 'descriptive':
+            for column in info.get('exploded_fields', []):
+                if column in siblings:
+                    sibling = siblings[column]
+                    models[column] = model(column, data_dictionary[sibling] if sibling else {'type': 'numeric'})
+        else:
+            models[field] = model(field, info)
+    return models
+
+# One cohort's block of rows, numbered from start + 1. The respondents' latent
+# age blanks grid columns of later life periods, also where the age answer
+# itself is missing.
+def generate_chunk(models, cohort, start, rows, seed, survey_dtype):
+    rng = np.random.default_rng([seed, zlib.crc32(cohort.encode('utf-8')), start])
+    columns = {}
+    age = None
+
+    for column, model in models.items():
+        kind = model['kind']
+        if kind == 'id':
+            columns[column] = convert_column(pd.Series(np.arange(start + 1, start + rows + 1)), model['dtype'])
+            continue
+
+        answered = rng.random(rows) >= model['missing'][cohort]
+        if model['gate'] is not None and model['gate'][0] in columns:
+            parent, value = model['gate']
+            answered &= (columns[parent] == value).fillna(False).to_numpy(dtype=bool)
+
+        if kind == 'checkbox':
+            # Unanswered questions have every option unchecked; answered ones at least one
+            checked = rng.random((rows, len(model['columns']))) < model['probs'][cohort]
+            if len(model['columns']):
+                empty = answered & ~checked.any(axis=1)
+                checked[empty, rng.integers(0, len(model['columns']), empty.sum())] = True
+            checked &= answered[:, None]
+            for i, name in enumerate(model['columns']):
+                columns[name] = pd.Series(checked[:, i], dtype='boolean')
+            continue
+
+        if model.get('period') is not None and age is not None:
+            answered &= age >= model['period']
+        if kind == 'choice':
+            categories = model['dtype'].categories
+            declared = len(model['probs'][cohort])
+            codes = rng.choice(declared, rows, p=model['probs'][cohort])
+            if model['invalid_rate']:
+                codes[rng.random(rows) < model['invalid_rate']] = len(categories) - 1
+            values = pd.Categorical.from_codes(np.where(answered, codes, -1), dtype=model['dtype'])
+        elif kind == 'boolean':
+            values = pd.array(rng.random(rows) < model['probs'][cohort], dtype='boolean')
+            values[~answered] = pd.NA
+        elif kind == 'text':
+            codes = rng.choice(len(model['pool']), rows, p=model['probs'])
+            values = pd.Categorical.from_codes(np.where(answered, codes, -1), categories=model['pool'])
+            values = pd.Series(values).astype(model['dtype'])
+        elif kind == 'age':
+            age = np.clip(np.rint(rng.normal(model['means'][cohort], 15, rows)), 18, 95).astype(int)
+            values = pd.array(age, dtype=model['dtype'])
+            values[~answered] = pd.NA
+        else:
+            values = pd.array(np.minimum(rng.poisson(model['lam'][cohort], rows), 99), dtype=model['dtype'])
+            values[~answered] = pd.NA
+        columns[column] = pd.Series(values)
+
+    columns[COHORT_COLUMN] = pd.Categorical.from_codes(np.full(rows, survey_dtype.categories.get_loc(cohort)), dtype=survey_dtype)
+    return pd.DataFrame(columns)
+
+# Write `rows` synthetic respondents split over the cohorts by mix ({cohort:
+# weight}) as <output>/data/combined, stacked by cohort like 01-data_pull.py
+# output, and copy the reference files and templates next to it. Returns the
+# number of rows per cohort.
+def generate(output, rows, mix=None, seed=0, chunksize=DEFAULT_CHUNKSIZE, invalid_rate=0.0, tsv=False):
+    mix = mix or {cohort: 1 for cohort in SURVEY_CATEGORIES}
+    for path in REFERENCE_FILES:
+        os.makedirs(os.path.join(output, os.path.dirname(path)), exist_ok=True)
+        shutil.copyfile(path, os.path.join(output, path))
+    shutil.copytree('templates', os.path.join(output, 'templates'), dirs_exist_ok=True)
+
+    data_dictionary, _ = read_data_dictionary()
+    with open('reference/column_config.json', encoding='utf-8') as f:
+        column_config = json.load(f)
+    models = column_models(data_dictionary, column_config, list(mix), seed, invalid_rate)
+    header = [name for column, model in models.items()
+              for name in (model['columns'] if model['kind'] == 'checkbox' else [column])] + [COHORT_COLUMN]
+
+    # Cohort categories as combine.combine_arms sets them
+    survey_dtype = pd.CategoricalDtype(SURVEY_CATEGORIES + [c for c in mix if c not in SURVEY_CATEGORIES])
+    sizes = cohort_sizes(rows, mix)
+    os.makedirs(os.path.join(output, DATA_DIR), exist_ok=True)
+    with DataWriter(os.path.join(output, DATA_DIR, 'combined'), header, tsv=tsv) as writer:
+        start = 0
+        for cohort, size in sizes.items():
+            for offset in range(0, size, chunksize):
+                count = min(chunksize, size - offset)
+                writer.write(generate_chunk(models, cohort, start, count, seed, survey_dtype))
+                start += count
+    return sizes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic combined dataset')
+    parser.add_argument('--output', required=True, help='directory to write data/, reference/ and templates/ to')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--cohorts', nargs='+', default=[f'{cohort}=1' for cohort in SURVEY_CATEGORIES],
+                        help="cohort mix as cohort=weight (default: equal shares)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help='rows generated at a time')
+    parser.add_argument('--invalid-rate', type=float, default=0.0,
+                        help=f'share of radio/dropdown answers set to the undeclared code {INVALID_CODE}')
+    parser.add_argument('--tsv', action='store_true', help='also write data/combined.tsv')
+    # parse_known_args keeps this runnable from Jupyter, which passes its own arguments
+    args, _ = parser.parse_known_args()
+
+    start = time.perf_counter()
+    sizes = generate(args.output, args.rows, parse_mix(args.cohorts), args.seed, args.chunksize,
+                     args.invalid_rate, args.tsv)
+    print(f"Wrote {args.rows:,} rows ({', '.join(f'{c} {n:,}' for c, n in sizes.items())}) "
+          f"to {os.path.join(args.output, DATA_DIR)} in {time.perf_counter() - start:.1f}s")
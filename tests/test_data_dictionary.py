@@ -0,0 +1,25 @@
+# Data dictionary compilation from REDCap metadata
+
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_dictionary import create_data_dictionary, parse_choices
+
+def test_parse_choices():
+    choices = pd.Series(['1, <b>Yes</b> | 0, No', None, 'no pairs', ''])
+    assert parse_choices(choices).tolist() == [{'1': 'Yes', '0': 'No'}, None, {}, {}]
+
+# Projects whose fields have no choice strings at all still get a dictionary
+def test_no_choice_strings():
+    assert parse_choices(pd.Series([None, None])).tolist() == [None, None]
+    metadata = pd.DataFrame({'field_name': ['record_id', 'age'], 'field_type': ['text', 'text'],
+                             'field_label': ['Record ID', 'Age'], 'select_choices_or_calculations': [None, None]})
+    combined = pd.DataFrame({'record_id': [1, 2], 'age': [30, 40]})
+    data_dictionary = create_data_dictionary(metadata, {'omit': [], 'non_standard_exploding': {}}, combined)
+    assert list(data_dictionary) == ['record_id', 'age']
+    assert data_dictionary['age']['type'] == 'numeric'
+    assert data_dictionary['age']['value_labels'] is None
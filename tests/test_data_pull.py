@@ -0,0 +1,198 @@
+# End-to-end run of 01-data_pull.py against mock_redcap.py on fresh raw files:
+# a copy of the repository pulls small generated projects whose exports keep
+# REDCap's '' blanks, as a real first pull does
+
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+import pandas as pd
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from redcap_pull import merge_records_streaming, write_raw
+from utils import read_data
+
+ROWS = 20
+
+# Completion field of each language arm, as named in 01-data_pull.py
+ARMS = {
+    'chinese_traditional': 'mac_sdoh_questionnaire_traditional_chinese_complete',
+    'chinese_simplified': 'mac_sdoh_questionnaire_chinese_complete',
+    'english': 'mac_sdoh_questionnaire_english_complete',
+    'spanish': 'mac_sdoh_questionnaire_spanish_complete',
+}
+
+# Metadata and records for every arm, shaped like the REDCap exports the
+# reference data dictionary was built from
+def write_projects(source, rows=ROWS, arms=ARMS):
+    with open(os.path.join(REPO, 'reference', 'data_dictionary.json'), encoding='utf-8') as f:
+        data_dictionary = json.load(f)
+    data_dictionary.pop('_meta', None)
+    columns = pd.read_csv(os.path.join(REPO, 'reference', 'data_types.tsv'), sep='\t')['Column']
+    checkbox_parent = {column: field for field, info in data_dictionary.items() if info.get('is_checkbox')
+                       for column in info.get('exploded_fields', [])}
+
+    metadata = [{'field_name': 'record_id', 'form_name': 'details', 'field_type': 'text',
+                 'field_label': 'Record ID', 'select_choices_or_calculations': ''}]
+    for field, info in data_dictionary.items():
+        if field == 'record_id':
+            continue
+        choices = ' | '.join(f'{code}, {label}' for code, label in (info['value_labels'] or {}).items())
+        metadata.append({'field_name': 'msoc_bas_45' if field == 'msoc_bas_46' else field,
+                         'form_name': 'mac_sdoh', 'field_type': 'text' if info['type'] == 'numeric' else info['type'],
+                         'field_label': info['label'], 'select_choices_or_calculations': choices})
+    metadata = pd.DataFrame(metadata)
+
+    rng = random.Random(1)
+    record_id = 1
+    for key, complete in arms.items():
+        records = []
+        for _ in range(rows):
+            row = {}
+            for column in columns:
+                info = data_dictionary.get(column, {})
+                if column == 'survey':
+                    continue
+                if column == 'record_id':
+                    value = str(record_id)
+                    record_id += 1
+                elif column in checkbox_parent:
+                    value = rng.choice(['0', '1'])
+                elif info.get('type') in ('radio', 'dropdown') and info.get('value_labels'):
+                    value = rng.choice(list(info['value_labels']) + [''])
+                elif info.get('type') == 'numeric':
+                    value = rng.choice([str(rng.randint(18, 90)), ''])
+                elif info.get('type') == 'text':
+                    value = rng.choice(['foo', 'bar', ''])
+                elif column.endswith('complete'):
+                    value = rng.choice(['0', '2'])
+                else:
+                    value = ''
+                row[column] = value
+            records.append(row)
+        df = pd.DataFrame(records)
+        # Checkbox columns export as <field>___<code>
+        renames = {column: f"{checkbox_parent[column]}___{column[len(checkbox_parent[column]) + 1:]}"
+                   for column in df.columns if column in checkbox_parent}
+        df = df.rename(columns={**renames, 'questionnaire_complete': complete, 'msoc_bas_46': 'msoc_bas_45'})
+        df.to_csv(os.path.join(source, f'{key}.tsv'), sep='\t', index=False)
+        metadata.to_csv(os.path.join(source, f'{key}_metadata.tsv'), sep='\t', index=False)
+
+@pytest.fixture
+def checkout(tmp_path):
+    root = tmp_path / 'repo'
+    tracked = subprocess.run(['git', 'ls-files'], cwd=REPO, capture_output=True, text=True, check=True).stdout
+    for name in tracked.splitlines():
+        if name.startswith('tests/'):
+            continue
+        os.makedirs(root / os.path.dirname(name), exist_ok=True)
+        shutil.copy2(os.path.join(REPO, name), root / name)
+    # 01 finds its data and dot.env from the git root
+    subprocess.run(['git', 'init', '-q'], cwd=root, check=True)
+    return root
+
+# Serves the ARMS projects, or the arms given by indirect parametrization
+@pytest.fixture
+def mock_redcap(tmp_path, request):
+    source = tmp_path / 'source'
+    source.mkdir()
+    write_projects(source, arms=getattr(request, 'param', ARMS))
+    mock = subprocess.Popen([sys.executable, '-u', os.path.join(REPO, 'mock_redcap.py'),
+                             '--source', str(source), '--port', '0'],
+                            stdout=subprocess.PIPE, text=True, cwd=REPO)
+    try:
+        yield mock.stdout.readline().strip() + '\n' + mock.stdout.readline().strip() + '\n'
+    finally:
+        mock.terminate()
+        mock.wait()
+
+def run_pull(checkout, *args, output=None):
+    result = subprocess.run([sys.executable, '01-data_pull.py', '--rate', '0', *args],
+                            cwd=checkout, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    if output is not None:
+        output.append(result.stdout)
+    return read_data(str(checkout / 'data' / 'combined'))
+
+@pytest.mark.parametrize('batch_size', [0, 7])
+def test_fresh_pull(checkout, mock_redcap, batch_size):
+    (checkout / 'dot.env').write_text(mock_redcap)
+    combined = run_pull(checkout, '--batch-size', str(batch_size))
+    assert len(combined) == ROWS * len(ARMS)
+    assert combined['record_id'].is_unique
+    assert_no_blanks(combined)
+
+    # A run from the cached raw files builds the same dataset
+    pd.testing.assert_frame_equal(run_pull(checkout, '--batch-size', str(batch_size)), combined)
+
+# Blanks are missing values, not a '' category or string
+def assert_no_blanks(df):
+    for column in df.columns:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            assert '' not in series.cat.categories, column
+        elif pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+            assert not series.eq('').any(), column
+
+# An incremental pull merges the records changed since the last pull, blanks
+# included, into the cached raw files
+@pytest.mark.parametrize('batch_size', [0, 7])
+def test_incremental_pull(tmp_path, checkout, mock_redcap, batch_size):
+    (checkout / 'dot.env').write_text(mock_redcap)
+    source = tmp_path / 'source' / 'english.tsv'
+    # Records last modified well before the pull's watermark overlap
+    old = time.time() - 3600
+    os.utime(source, (old, old))
+    run_pull(checkout, '--batch-size', str(batch_size))
+
+    records = pd.read_csv(source, sep='\t', dtype=str, keep_default_na=False)
+    records.loc[3, 'first_name'] = ''
+    records.loc[4, 'first_name'] = 'changed'
+    added = records.iloc[[0]].assign(record_id='9999')
+    pd.concat([records, added]).to_csv(source, sep='\t', index=False)
+
+    combined = run_pull(checkout, '--incremental', '--batch-size', str(batch_size))
+    assert len(combined) == ROWS * len(ARMS) + 1
+    english = combined.set_index('record_id')
+    assert pd.isna(english.loc[int(records.loc[3, 'record_id']), 'first_name'])
+    assert english.loc[int(records.loc[4, 'record_id']), 'first_name'] == 'changed'
+    assert 9999 in english.index
+    assert_no_blanks(combined)
+    raw = read_data(str(checkout / 'data' / 'raw' / 'english'), dtype=str)
+    assert not raw.eq('').any().any()
+
+# A project cached before it had any records takes its first delta
+def test_merge_into_empty_raw_file(tmp_path):
+    raw_base = str(tmp_path / 'project')
+    write_raw(pd.DataFrame(columns=['record_id', 'name']), raw_base)
+    merge_records_streaming(raw_base, pd.DataFrame({'record_id': ['1'], 'name': ['a']}), 'record_id', 7)
+    assert read_data(raw_base, dtype=str).to_dict('records') == [{'record_id': '1', 'name': 'a'}]
+
+# Pull settings in dot.env apply although the pull modules are imported
+# before it is loaded
+def test_dotenv_settings(checkout, mock_redcap):
+    (checkout / 'dot.env').write_text(mock_redcap + 'PULL_WORKERS = 1\nPULL_BATCH_SIZE = 7\n')
+    output = []
+    run_pull(checkout, output=output)
+    assert 'with 1 worker(s)' in output[0]
+    # Metadata, record IDs and one export per batch of 7 records
+    requests = len(ARMS) * (2 + -(-ROWS // 7))
+    assert f'REDCap API: {requests} request(s)' in output[0]
+
+# An arm missing from 01's completion field map is combined with its own
+# completion field instead of stopping the pull
+@pytest.mark.parametrize('mock_redcap', [{**ARMS, 'korean': 'mac_sdoh_questionnaire_korean_complete'}],
+                         indirect=True)
+def test_unknown_arm(checkout, mock_redcap):
+    (checkout / 'dot.env').write_text(mock_redcap)
+    combined = run_pull(checkout)
+    assert len(combined) == ROWS * (len(ARMS) + 1)
+    assert (combined['survey'] == 'korean').sum() == ROWS
+    assert 'mac_sdoh_questionnaire_korean_complete' in combined.columns
@@ -0,0 +1,77 @@
+# Transport retries against a local server that fails the first requests
+
+import json
+import os
+import sys
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redcap_client import RedcapError, RedcapProject, Transport, server_time
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Requests to answer with a response body cut off halfway, then the answer
+    failures = 0
+    calls = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        type(self).calls += 1
+        body = json.dumps([{'record_id': '1'}]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.calls <= self.failures:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def flaky_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def serve(server, failures):
+    FlakyHandler.failures, FlakyHandler.calls = failures, 0
+    return f"http://127.0.0.1:{server.server_port}/api/"
+
+def test_truncated_body_is_retried(flaky_server, monkeypatch):
+    monkeypatch.setattr('redcap_client.BACKOFF_BASE', 0.0)
+    url = serve(flaky_server, failures=2)
+    with Transport(retries=3, rate=0) as transport:
+        assert transport.post(url, {'content': 'record'}) == [{'record_id': '1'}]
+        stats = transport.stats()
+    assert FlakyHandler.calls == 3
+    assert stats['requests'] == 3 and stats['retries'] == 2 and stats['failed'] == 2
+
+def test_truncated_body_fails_after_retries(flaky_server, monkeypatch):
+    monkeypatch.setattr('redcap_client.BACKOFF_BASE', 0.0)
+    url = serve(flaky_server, failures=10)
+    with Transport(retries=2, rate=0) as transport, pytest.raises(RedcapError):
+        transport.post(url, {'content': 'record'})
+    assert FlakyHandler.calls == 3
+
+# Watermarks are in the server's zone, taken from its Date header when it sends one
+def test_server_time(flaky_server, monkeypatch):
+    monkeypatch.setenv('REDCAP_TZ', 'America/Los_Angeles')
+    assert server_time(datetime(2024, 7, 1, 12, 0, tzinfo=timezone.utc)) == datetime(2024, 7, 1, 5, 0)
+    project = RedcapProject(serve(flaky_server, failures=0), 'token', Transport(rate=0))
+    project.call('record')
+    assert project.date is not None and project.date.tzinfo is not None
+    assert abs(server_time(project.date) - server_time()).total_seconds() < 5
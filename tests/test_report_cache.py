@@ -0,0 +1,115 @@
+# Incremental report builds: an entry is rebuilt when its domain map row, its
+# columns' data or dictionary entries, or the cohorts change, and read from the
+# entry cache otherwise
+
+import importlib.util
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from report_cache import REPORT_CACHE_DIR, write_entry
+
+ROWS = 40
+ARGS = ['--incremental', '--renderer', 'svg', '--workers', '1', '--no-chart-cache']
+
+DOMAIN_MAP = pd.DataFrame([
+    ['Demographics', 'Sex', 'sex'],
+    ['Demographics', 'Age', 'age'],
+    ['Background', 'Reasons to move', 'reasons'],
+    ['Background', 'Work by sex', 'work, sex'],
+], columns=['domain', 'item', 'column_name'])
+
+def survey_data(rows=ROWS):
+    rng = np.random.default_rng(5)
+    data = pd.DataFrame({
+        'survey': rng.choice(['english', 'spanish'], rows).astype(object),
+        'sex': pd.Categorical(rng.choice(['1', '2', None], rows), categories=['1', '2']),
+        'age': rng.integers(18, 90, rows).astype('float64'),
+        'reasons_1': rng.integers(0, 2, rows),
+        'reasons_2': rng.integers(0, 2, rows),
+        'work': pd.Categorical(rng.choice(['1', '2', '3'], rows), categories=['1', '2', '3']),
+    })
+    data_dict = {
+        'sex': {'type': 'radio', 'label': 'Sex', 'value_labels': {'1': 'Male', '2': 'Female'}},
+        'age': {'type': 'numeric', 'label': 'Age', 'value_labels': None},
+        'reasons': {'type': 'checkbox', 'label': 'Reasons to move', 'value_labels': {'1': 'Work', '2': 'Family'},
+                    'is_checkbox': True, 'exploded_fields': ['reasons_1', 'reasons_2']},
+        'work': {'type': 'radio', 'label': 'Work', 'value_labels': {'1': 'None', '2': 'Part time', '3': 'Full time'}},
+    }
+    return data, data_dict
+
+# A working directory with the report templates, the domain map and an empty cache
+@pytest.fixture
+def report(tmp_path, monkeypatch):
+    shutil.copytree(os.path.join(REPO, 'templates'), tmp_path / 'templates')
+    (tmp_path / 'reference').mkdir()
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location('stage_report', os.path.join(REPO, '03-generate_report.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Build the report from domain_map, data and data_dict; returns the (domain,
+# item) of the entries built rather than read from the cache, and the page
+def build(report, monkeypatch, domain_map, data, data_dict):
+    domain_map.to_csv(os.path.join('reference', 'domain_map.tsv'), sep='\t', index=False)
+    built = set()
+
+    def record(fingerprint, entry):
+        built.add((entry['domain'], entry['item']))
+        write_entry(fingerprint, entry)
+
+    monkeypatch.setattr(report, 'write_entry', record)
+    path = report.main(ARGS, data=(data, data_dict))
+    with open(path) as f:
+        return built, f.read()
+
+def change_data(domain_map, data, data_dict):
+    data.loc[3, 'age'] += 1
+    return {('Demographics', 'Age')}
+
+def change_shared_column(domain_map, data, data_dict):
+    data_dict['sex']['label'] = 'Sex at birth'
+    return {('Demographics', 'Sex'), ('Background', 'Work by sex')}
+
+def change_exploded_column(domain_map, data, data_dict):
+    data.loc[3, 'reasons_2'] = 1 - data.loc[3, 'reasons_2']
+    return {('Background', 'Reasons to move')}
+
+def change_checkbox_labels(domain_map, data, data_dict):
+    data_dict['reasons']['value_labels']['2'] = 'Family reasons'
+    return {('Background', 'Reasons to move')}
+
+def change_domain_map_row(domain_map, data, data_dict):
+    domain_map.loc[3, 'item'] = 'Employment by sex'
+    return {('Background', 'Employment by sex')}
+
+def change_cohorts(domain_map, data, data_dict):
+    data.loc[3, 'survey'] = 'spanish' if data.loc[3, 'survey'] == 'english' else 'english'
+    return {(row.domain, row.item) for row in domain_map.itertuples()}
+
+@pytest.mark.parametrize('change', [change_data, change_shared_column, change_exploded_column,
+                                    change_checkbox_labels, change_domain_map_row, change_cohorts])
+def test_incremental_build(report, monkeypatch, change):
+    domain_map = DOMAIN_MAP.copy()
+    data, data_dict = survey_data()
+    built, page = build(report, monkeypatch, domain_map, data, data_dict)
+    assert built == {(row.domain, row.item) for row in domain_map.itertuples()}
+
+    # Nothing changed: every entry is read from the cache, into the same page
+    rebuilt, cached_page = build(report, monkeypatch, domain_map, data, data_dict)
+    assert rebuilt == set()
+    assert cached_page == page
+
+    expected = change(domain_map, data, data_dict)
+    rebuilt, _ = build(report, monkeypatch, domain_map, data, data_dict)
+    assert rebuilt == expected
+    # Entries of the old inputs are evicted
+    assert len(os.listdir(REPORT_CACHE_DIR)) == len(domain_map)
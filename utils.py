@@ -2,44 +2,415 @@ import pandas as pd
 import numpy as np
 import os
 import json
+import hashlib
+import time
+
+import profiling
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 DATA_DIR = 'data'
 RAW_DIR = os.path.join(DATA_DIR, 'raw')
+DOMAIN_MAP = 'reference/domain_map.tsv'
+# Snapshots of typed frames returned by load_data (Arrow IPC, needs pyarrow)
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+# Bump when the typing applied by load_data changes, so older snapshots are rebuilt
+SNAPSHOT_VERSION = 1
+# Column holding each row's cohort
+COHORT_COLUMN = 'survey'
+
+# Raw and combined datasets are stored as Parquet when pyarrow is installed.
+# TSV remains available as an opt-in interchange copy, and is the only format
+# written without pyarrow. Datasets are addressed by path without extension.
+PARQUET = pa is not None
+# Rows per Parquet row group; chunked readers decode at least one group at a time
+ROW_GROUP_SIZE = 5000
+
+# Dictionary types stored as strings, categoricals and nullable booleans in the
+# combined dataset; other columns are stored as numbers when every value converts
+TEXT_TYPES = ['text', 'notes', 'descriptive']
+CATEGORY_TYPES = ['radio', 'dropdown']
+BOOLEAN_TYPES = ['yesno', 'truefalse']
+STRING_DTYPE = 'string[pyarrow]' if PARQUET else 'string'
+# Numeric types produced by compact_numeric
+COMPACT_DTYPES = ['Int8', 'Int16', 'Int32', 'Int64', 'float32']
+
+# Key holding build information in data_dictionary.json. REDCap field names
+# start with a letter, so it cannot clash with a field.
+DICTIONARY_META = '_meta'
 
-def load_data():
-    # Load the combined TSV file
-    df = pd.read_csv(os.path.join(DATA_DIR, 'combined.tsv'), sep='\t')
-    
-    # Load the data dictionary
-    with open('reference/data_dictionary.json', 'r') as f:
+# Value of an environment setting, or default when it is unset or empty. Read
+# when called rather than at import, so settings loaded from dot.env after the
+# pull modules are imported still apply.
+def env_setting(name, default, cast=int):
+    value = os.getenv(name)
+    return default if value is None or value.strip() == '' else cast(value)
+
+# Returns the field entries and the build hash (None for dictionaries written
+# before hashes were recorded)
+def read_data_dictionary(path='reference/data_dictionary.json'):
+    with open(path, 'r', encoding='utf-8') as f:
         data_dictionary = json.load(f)
-    
-    # Apply data types and categories based on data dictionary
-    for column, info in data_dictionary.items():
-        if column == 'survey':
-            continue
-        
+    meta = data_dictionary.pop(DICTIONARY_META, {})
+    return data_dictionary, meta.get('build_hash')
+
+# Existing file for a dataset, preferring Parquet over TSV
+def data_file(base):
+    for ext in ('.parquet', '.tsv'):
+        if os.path.exists(base + ext):
+            return base + ext
+    return None
+
+# Column names of a dataset, read from the Parquet schema or the TSV header
+def data_columns(base):
+    path = data_file(base)
+    if path is None:
+        raise FileNotFoundError(f"No .parquet or .tsv file found for {base}")
+    if path.endswith('.tsv'):
+        return list(pd.read_csv(path, sep='\t', nrows=0).columns)
+    return pq.read_schema(path).names
+
+# Keep rows matching every (column, op, value) filter, with op '==' or 'in'
+def filter_rows(df, filters):
+    keep = np.ones(len(df), dtype=bool)
+    for column, op, value in filters:
+        if op == 'in':
+            keep &= df[column].isin(value).to_numpy()
+        elif op == '==':
+            keep &= (df[column] == value).to_numpy()
+        else:
+            raise ValueError(f"Unsupported filter operator '{op}'")
+    return df[keep].reset_index(drop=True)
+
+# dtype only applies to TSV files; Parquet files carry their own column types.
+# filters are (column, op, value) tuples ('==' or 'in'); Parquet files apply
+# them while reading, TSV files after parsing.
+def read_data(base, columns=None, dtype=None, filters=None):
+    path = data_file(base)
+    if path is None:
+        raise FileNotFoundError(f"No .parquet or .tsv file found for {base}")
+    if path.endswith('.tsv'):
+        df = pd.read_csv(path, sep='\t', usecols=columns, dtype=dtype)
+        return filter_rows(df, filters) if filters else df
+    # Arrow-backed string columns are written as large_string; restore them as
+    # such instead of the default Python-object storage
+    table = pq.read_table(path, columns=columns, filters=filters or None)
+    df = table.to_pandas(types_mapper={pa.large_string(): pd.StringDtype('pyarrow')}.get)
+    # Missing strings come back as None; match read_csv's NaN
+    text_columns = df.columns[df.dtypes == object]
+    if len(text_columns):
+        values = df[text_columns].to_numpy()
+        text = pd.DataFrame(np.where(pd.isna(values), np.nan, values), index=df.index, columns=text_columns)
+        # Rebuild rather than assign in place, which would fragment the frame
+        df = pd.concat([df.drop(columns=text_columns), text], axis=1)[df.columns]
+    return df
+
+# Read a dataset in chunks of at most chunksize rows. TSV files are parsed with
+# dtype (strings by default); filters are applied to each chunk.
+def iter_data(base, chunksize, columns=None, dtype=str, filters=None):
+    path = data_file(base)
+    if path is None:
+        raise FileNotFoundError(f"No .parquet or .tsv file found for {base}")
+    if path.endswith('.tsv'):
+        chunks = pd.read_csv(path, sep='\t', usecols=columns, dtype=dtype, chunksize=chunksize)
+    else:
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns)
+        chunks = (batch.to_pandas(types_mapper={pa.large_string(): pd.StringDtype('pyarrow')}.get) for batch in batches)
+    for chunk in chunks:
+        yield filter_rows(chunk, filters) if filters else chunk
+
+def write_data(df, base, tsv=False):
+    if PARQUET:
+        df.to_parquet(base + '.parquet', index=False, row_group_size=ROW_GROUP_SIZE)
+    if tsv or not PARQUET:
+        df.to_csv(base + '.tsv', index=False, sep='\t')
+
+# Streams chunks with a fixed header to <base>.parquet and/or <base>.tsv.
+# Files are written under a .part name and moved into place on close, so an
+# interrupted write never leaves a truncated dataset. With strings=True every
+# column is stored as a string (raw REDCap exports are all strings).
+class DataWriter:
+    def __init__(self, base, header, tsv=False, strings=False):
+        self.base = base
+        self.header = list(header)
+        self.parquet_writer = None
+        self.tsv_file = None
+        if PARQUET:
+            self.schema = pa.schema([(col, pa.string()) for col in self.header]) if strings else None
+        if tsv or not PARQUET:
+            self.tsv_file = open(f"{base}.tsv.part", 'w', newline='', encoding='utf-8')
+            pd.DataFrame(columns=self.header).to_csv(self.tsv_file, sep='\t', index=False)
+
+    def write(self, chunk):
+        chunk = chunk.reindex(columns=self.header)
+        if PARQUET:
+            table = pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False)
+            if self.parquet_writer is None:
+                self.schema = table.schema
+                self.parquet_writer = pq.ParquetWriter(f"{self.base}.parquet.part", self.schema)
+            self.parquet_writer.write_table(table)
+        if self.tsv_file is not None:
+            chunk.to_csv(self.tsv_file, sep='\t', index=False, header=False)
+
+    def close(self):
+        if PARQUET:
+            if self.parquet_writer is None:
+                self.write(pd.DataFrame(columns=self.header))
+            self.parquet_writer.close()
+            os.replace(f"{self.base}.parquet.part", f"{self.base}.parquet")
+        if self.tsv_file is not None:
+            self.tsv_file.close()
+            os.replace(f"{self.base}.tsv.part", f"{self.base}.tsv")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+            return
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        if self.tsv_file is not None:
+            self.tsv_file.close()
+        for ext in ('.parquet.part', '.tsv.part'):
+            if os.path.exists(self.base + ext):
+                os.remove(self.base + ext)
+
+# Column dtypes of the combined dataset, compiled once from the data dictionary:
+# radio/dropdown fields are categoricals over their declared codes, yes/no
+# fields and checkbox columns are nullable booleans and text-like fields are
+# strings. Columns without an entry are numeric and get the smallest adequate
+# width from their values (see compact_numeric).
+def compile_dtypes(data_dictionary):
+    dtypes = {}
+    for field, info in data_dictionary.items():
         field_type = info['type']
-        
-        if field_type == 'checkbox':
-            # For checkbox fields, look for the exploded columns
-            checkbox_columns = [col for col in df.columns if col.startswith(f"{column}___")]
-            for checkbox_col in checkbox_columns:
-                df[checkbox_col] = df[checkbox_col].astype(bool)
-        elif column in df.columns:
-            if field_type in ['radio', 'dropdown']:
-                df[column] = pd.Categorical(df[column])
-            elif field_type == 'text':
-                df[column] = df[column].astype(str)
-            elif field_type in ['number', 'calc']:
-                df[column] = pd.to_numeric(df[column], errors='coerce')
-            elif field_type == 'yesno':
-                df[column] = df[column].map({'1': True, '0': False})
-            elif field_type == 'date_ymd':
-                df[column] = pd.to_datetime(df[column], errors='coerce')
-    
+        if field_type in CATEGORY_TYPES:
+            codes = list(info['value_labels'] or {})
+            # Integer codes become integer categories, matching the stored values
+            if codes and all(code.lstrip('-').isdigit() for code in codes):
+                codes = list(dict.fromkeys(int(code) for code in codes))
+            dtypes[field] = pd.CategoricalDtype(codes)
+        elif field_type in BOOLEAN_TYPES:
+            dtypes[field] = 'boolean'
+        elif field_type in TEXT_TYPES:
+            dtypes[field] = STRING_DTYPE
+        elif field_type == 'checkbox':
+            for column in info.get('exploded_fields', []):
+                dtypes[column] = 'boolean'
+    return dtypes
+
+# Smallest nullable integer type that holds every value of an integer-valued
+# column, or float32 for floats that survive the round trip; float64 otherwise
+def compact_numeric(series):
+    values = series.dropna()
+    if pd.api.types.is_integer_dtype(series) or (values % 1 == 0).all():
+        low, high = (values.min(), values.max()) if len(values) else (0, 0)
+        for dtype in ('Int8', 'Int16', 'Int32', 'Int64'):
+            info = np.iinfo(dtype.lower())
+            if info.min <= low and high <= info.max:
+                return series.astype(dtype)
+    narrow = values.astype('float32')
+    if (narrow.astype('float64') == values).all():
+        return series.astype('float32')
+    return series
+
+# A fresh REDCap export writes missing values as blank strings
+def blank_to_na(series):
+    if series.dtype != object:
+        return series
+    return series.mask(series.eq(''))
+
+# Convert a column to its compiled dtype. Values outside a categorical's
+# declared codes are kept as extra categories so nothing is lost; the
+# validation step reports them. Parquet does not keep categoricals with integer
+# categories, so those are rebuilt here from the stored codes.
+def convert_column(series, dtype):
+    if isinstance(dtype, pd.CategoricalDtype):
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            return series
+        categories = list(dtype.categories)
+        series = blank_to_na(series)
+        if series.dtype == object and pd.api.types.is_integer_dtype(dtype.categories):
+            numeric = pd.to_numeric(series, errors='coerce')
+            if numeric.notna().sum() == series.notna().sum():
+                series = numeric
+        if not pd.api.types.is_numeric_dtype(series):
+            # Columns that are not all numeric keep their codes as strings
+            categories = [str(code) for code in categories]
+        values = pd.Categorical(series, categories=categories)
+        outside = values.isna() & series.notna().to_numpy()
+        if outside.any():
+            extras = sorted(set(series[outside]), key=str)
+            # Stray values of string-coded columns stay strings
+            if pd.api.types.is_numeric_dtype(series) and pd.api.types.is_integer_dtype(dtype.categories):
+                extras = [int(value) if float(value).is_integer() else value for value in extras]
+            values = pd.Categorical(series, categories=categories + extras)
+        return pd.Series(values, index=series.index, name=series.name)
+    if dtype == 'boolean':
+        if series.dtype == 'boolean':
+            return series
+        return pd.to_numeric(series, errors='coerce').astype('boolean')
+    if series.dtype == dtype:
+        return series
+    return series.astype(dtype)
+
+# Type the combined dataset from the data dictionary. Columns that already have
+# their compiled (or a compact numeric) type are left untouched, so a typed
+# Parquet file only needs its categoricals rebuilt on load. Other columns become
+# numeric when every value converts and are then narrowed.
+def apply_storage_types(df, data_dictionary, dtypes=None):
+    if dtypes is None:
+        dtypes = compile_dtypes(data_dictionary)
+    converted = {}
+    for col in df.columns:
+        series = original = df[col]
+        if col in dtypes:
+            typed = convert_column(series, dtypes[col])
+        elif isinstance(series.dtype, pd.CategoricalDtype) or str(series.dtype) in COMPACT_DTYPES:
+            continue
+        else:
+            if series.dtype == object:
+                series = blank_to_na(series)
+                numeric = pd.to_numeric(series, errors='coerce')
+                if numeric.notna().sum() != series.notna().sum():
+                    continue
+                series = numeric
+            typed = compact_numeric(series) if pd.api.types.is_numeric_dtype(series) else series
+        if typed is not original:
+            converted[col] = typed
+    return df.assign(**converted) if converted else df
+
+# Parent fields listed for the given domains in the domain map
+def domain_fields(domains, domain_map_path=DOMAIN_MAP):
+    domain_map = pd.read_csv(domain_map_path, sep='\t')
+    names = domain_map.loc[domain_map['domain'].isin(domains), 'column_name']
+    return list(dict.fromkeys(field for value in names for field in value.split(', ')))
+
+# Dataset columns needed for the given fields: checkbox and other exploding
+# fields resolve to their exploded columns, other names are used as-is. The
+# record ID and cohort columns are always included, and columns are returned in
+# dataset order.
+def resolve_columns(fields, data_dictionary, available):
+    wanted = {next(iter(data_dictionary), None), COHORT_COLUMN}
+    for field in fields:
+        wanted.add(field)
+        wanted.update(data_dictionary.get(field, {}).get('exploded_fields', []))
+    return [col for col in available if col in wanted]
+
+# Identifies a file's current contents without reading it
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def snapshot_key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()[:16]
+
+def write_snapshot(df, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.OSFile(path + '.part', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(path + '.part', path)
+
+# Snapshots are memory-mapped, so only the columns' buffers are read
+def read_snapshot(path):
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(types_mapper={pa.large_string(): pd.StringDtype('pyarrow')}.get)
+
+# Remove snapshots built from other versions of the combined dataset (all of
+# them when keep is None)
+def evict_snapshots(keep=None):
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith('combined-') and not (keep and name.startswith(keep)):
+            os.remove(os.path.join(CACHE_DIR, name))
+
+# Load the combined dataset typed by the data dictionary. Parquet files are
+# written typed by 01-data_pull.py; TSV files get the nullable boolean and
+# string types at parse time and are narrowed afterwards.
+# columns (field names) and domains (domain_map domains) limit the columns read
+# from disk; cohorts keeps only rows of those cohorts. The full dictionary is
+# returned either way.
+# With cache=True the typed frame is kept as an Arrow IPC snapshot in CACHE_DIR,
+# keyed by the combined file's fingerprint, the dictionary build hash and the
+# projection; a changed input gives a new key and drops the old snapshots.
+def load_data(columns=None, domains=None, cohorts=None, cache=True):
+    start = time.perf_counter()
+    data_dictionary, build_hash = read_data_dictionary('reference/data_dictionary.json')
+    base = os.path.join(DATA_DIR, 'combined')
+    projection, filters = combined_projection(data_dictionary, columns, domains, cohorts)
+
+    snapshot = None
+    if cache and PARQUET:
+        path = data_file(base)
+        if path is None:
+            raise FileNotFoundError(f"No .parquet or .tsv file found for {base}")
+        # The dictionary is hashed itself when it predates recorded build hashes
+        dictionary = build_hash or file_fingerprint('reference/data_dictionary.json')
+        inputs = snapshot_key(SNAPSHOT_VERSION, file_fingerprint(path), dictionary)
+        snapshot = os.path.join(CACHE_DIR, f"combined-{inputs}-{snapshot_key(projection, filters)}.arrow")
+        if os.path.exists(snapshot):
+            with profiling.span('read snapshot', file=snapshot):
+                df = read_snapshot(snapshot)
+            print(f"Loaded combined data from snapshot in {time.perf_counter() - start:.2f}s")
+            return df, data_dictionary
+        evict_snapshots(f"combined-{inputs}-")
+
+    dtypes = compile_dtypes(data_dictionary)
+    with profiling.span('read data', file=data_file(base), columns=len(projection) if projection else None):
+        df = read_data(base, columns=projection, dtype=parse_dtypes(dtypes), filters=filters)
+    with profiling.span('apply storage types', columns=len(df.columns)):
+        df = apply_storage_types(df, data_dictionary, dtypes)
+    if snapshot is not None:
+        with profiling.span('write snapshot', file=snapshot):
+            write_snapshot(df, snapshot)
+        print(f"Loaded combined data in {time.perf_counter() - start:.2f}s (snapshot saved)")
     return df, data_dictionary
 
+# Typed chunks of the combined dataset of at most chunksize rows, for data that
+# does not fit in memory. Takes the same projection options as load_data and
+# returns the chunk iterator, the projected columns and the data dictionary.
+def iter_combined(chunksize, columns=None, domains=None, cohorts=None):
+    data_dictionary, _ = read_data_dictionary('reference/data_dictionary.json')
+    base = os.path.join(DATA_DIR, 'combined')
+    projection, filters = combined_projection(data_dictionary, columns, domains, cohorts)
+    dtypes = compile_dtypes(data_dictionary)
+    chunks = iter_data(base, chunksize, columns=projection, dtype=parse_dtypes(dtypes), filters=filters)
+    typed = (apply_storage_types(chunk, data_dictionary, dtypes) for chunk in chunks)
+    return typed, projection or data_columns(base), data_dictionary
+
+# Columns load_data returns for the column options, without reading any data,
+# and the data dictionary
+def combined_columns(columns=None, domains=None):
+    data_dictionary, _ = read_data_dictionary('reference/data_dictionary.json')
+    projection, _ = combined_projection(data_dictionary, columns, domains)
+    return projection or data_columns(os.path.join(DATA_DIR, 'combined')), data_dictionary
+
+# Columns to read and row filters for load_data's projection options
+def combined_projection(data_dictionary, columns=None, domains=None, cohorts=None):
+    projection = None
+    if columns is not None or domains is not None:
+        fields = list(columns or []) + domain_fields(domains or [])
+        projection = resolve_columns(fields, data_dictionary, data_columns(os.path.join(DATA_DIR, 'combined')))
+    filters = [(COHORT_COLUMN, 'in', list(cohorts))] if cohorts is not None else None
+    return projection, filters
+
+# TSV parse types: categoricals are built after parsing, since values outside
+# the declared codes would otherwise be lost
+def parse_dtypes(dtypes):
+    parsed = {col: dtype for col, dtype in dtypes.items() if not isinstance(dtype, pd.CategoricalDtype)}
+    parsed[COHORT_COLUMN] = 'category'
+    return parsed
+
 def in_notebook():
     try:
         from IPython import get_ipython
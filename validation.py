@@ -0,0 +1,266 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import profiling
+from utils import PARQUET, compile_dtypes, iter_combined, load_data
+
+# Report sections of 02-validate.py and the rules printed under each
+SECTIONS = {
+    'Data type inconsistencies': ['type'],
+    'Value range inconsistencies': ['value_range'],
+    'Checkbox inconsistencies': ['checkbox_type', 'unexpected_column'],
+    'Missing columns': ['missing_column'],
+}
+
+# Columns of a results table. Each row is one failed rule: 'count' is the
+# number of offending rows (1 for rules about the columns themselves), 'values'
+# the offending values or dtype and 'record_ids' the offending records.
+RESULT_COLUMNS = ['rule', 'field', 'column', 'expected', 'count', 'values', 'record_ids']
+
+def type_matches(expected_type, actual_type):
+    if expected_type in ['radio', 'dropdown', 'checkbox', 'checkbox_option']:
+        return isinstance(actual_type, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(actual_type)
+    elif expected_type == 'text':
+        return pd.api.types.is_string_dtype(actual_type)
+    elif expected_type in ['number', 'calc']:
+        return pd.api.types.is_numeric_dtype(actual_type)
+    elif expected_type == 'yesno':
+        return pd.api.types.is_bool_dtype(actual_type)
+    elif expected_type == 'date_ymd':
+        return pd.api.types.is_datetime64_any_dtype(actual_type)
+    return True  # Default to True for unknown types
+
+# Compile the data dictionary into a rule table, one row per (rule, column):
+#   type             column dtype matches the field type
+#   value_range      radio/dropdown values are declared codes
+#   checkbox_type    exploded checkbox columns are boolean
+#   missing_column   expected columns (exploded ones for checkboxes) exist
+#   unexpected_column  columns named like a checkbox's children are declared
+def compile_rules(data_dictionary, columns):
+    columns = list(columns)
+    present = set(columns)
+    dtypes = compile_dtypes(data_dictionary)
+    rules = []
+    exploded = {}
+
+    for field, info in data_dictionary.items():
+        field_type = info['type']
+        if field in present:
+            rules.append(('type', field, field, field_type))
+            if field_type in ['radio', 'dropdown']:
+                rules.append(('value_range', field, field, list(dtypes[field].categories)))
+
+        if info.get('exploding') or info.get('is_checkbox'):
+            if 'exploded_fields' not in info:
+                kind = 'exploding' if info.get('exploding') else 'checkbox'
+                print(f"Warning: {field} is marked as {kind} but does not have 'exploded_fields' defined in the data dictionary.")
+                continue
+            for column in info['exploded_fields']:
+                rules.append(('missing_column', field, column, None))
+                if field_type == 'checkbox':
+                    exploded[column] = field
+                    if column in present:
+                        rules.append(('checkbox_type', field, column, 'boolean'))
+        elif field not in present:
+            rules.append(('missing_column', field, field, None))
+
+    # Children follow "<checkbox>_<code>"; anything else with that shape is unexpected
+    checkboxes = set(exploded.values())
+    for column in columns:
+        parent = column.rsplit('_', 1)[0]
+        if parent in checkboxes and column not in exploded and column not in data_dictionary:
+            rules.append(('unexpected_column', parent, column, None))
+
+    return pd.DataFrame(rules, columns=['rule', 'field', 'column', 'expected'])
+
+# Rows of a value_range rule whose value is not a declared code. Categoricals
+# are checked on their categories and matched to rows through the codes.
+def invalid_rows(series, valid):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = series.cat.categories
+        invalid = np.flatnonzero(~categories.isin(valid))
+        if not len(invalid):
+            return np.zeros(len(series), dtype=bool)
+        return np.isin(series.cat.codes.to_numpy(), invalid)
+    return (series.notna() & ~series.isin(valid)).to_numpy()
+
+# Evaluate a rule table against df. Returns a results table (RESULT_COLUMNS)
+# with one row per failed rule.
+def evaluate_rules(df, rules, record_id):
+    present = set(df.columns)
+    record_ids = df[record_id] if record_id in present else pd.Series(df.index, index=df.index)
+    results = []
+    for rule, field, column, expected in rules.itertuples(index=False):
+        with profiling.span(f'rule {rule}', field=field, column=column):
+            if rule == 'type':
+                if not type_matches(expected, df[column].dtype):
+                    results.append((rule, field, column, expected, 1, [str(df[column].dtype)], []))
+            elif rule == 'value_range':
+                rows = invalid_rows(df[column], expected)
+                if rows.any():
+                    values = pd.unique(df[column][rows].astype(object)).tolist()
+                    results.append((rule, field, column, expected, int(rows.sum()), values, record_ids[rows].tolist()))
+            elif rule == 'checkbox_type':
+                if not pd.api.types.is_bool_dtype(df[column]):
+                    results.append((rule, field, column, expected, 1, [str(df[column].dtype)], []))
+            elif rule == 'missing_column':
+                if column not in present:
+                    results.append((rule, field, column, expected, 1, [], []))
+            elif rule == 'unexpected_column':
+                results.append((rule, field, column, expected, 1, [], []))
+    return pd.DataFrame(results, columns=RESULT_COLUMNS)
+
+# record_id defaults to the dictionary's first field
+def validate(df, data_dictionary, record_id=None):
+    with profiling.span('compile rules', columns=len(df.columns)):
+        rules = compile_rules(data_dictionary, df.columns)
+    return evaluate_rules(df, rules, record_id or next(iter(data_dictionary), None))
+
+# Rules evaluated per row; the others are about the columns themselves and give
+# the same result for every chunk
+ROW_RULES = ['value_range']
+
+# Add one chunk's results to the running per-rule accumulators: row counts are
+# summed, offending values kept as an ordered distinct set and record_ids
+# appended. Column rules keep their first result.
+def fold_results(accumulators, results):
+    for row in results.itertuples(index=False):
+        key = (row.rule, row.field, row.column)
+        accumulator = accumulators.get(key)
+        if accumulator is None:
+            accumulators[key] = {'expected': row.expected, 'count': row.count,
+                                 'values': dict.fromkeys(row.values), 'record_ids': list(row.record_ids)}
+        elif row.rule in ROW_RULES:
+            accumulator['count'] += row.count
+            accumulator['values'].update(dict.fromkeys(row.values))
+            accumulator['record_ids'].extend(row.record_ids)
+    return accumulators
+
+# Results table from folded accumulators, in rule table order like evaluate_rules
+def accumulated_results(accumulators, rules):
+    results = []
+    for rule, field, column, _ in rules.itertuples(index=False):
+        accumulator = accumulators.get((rule, field, column))
+        if accumulator is not None:
+            results.append((rule, field, column, accumulator['expected'], accumulator['count'],
+                            list(accumulator['values']), accumulator['record_ids']))
+    return pd.DataFrame(results, columns=RESULT_COLUMNS)
+
+# Streaming counterpart of validate for chunks of the same columns (see
+# utils.iter_combined). Only the accumulators outlive a chunk, so memory is
+# bounded by the chunk size plus the offending record_ids.
+def validate_chunks(chunks, columns, data_dictionary, record_id=None):
+    rules = compile_rules(data_dictionary, columns)
+    record_id = record_id or next(iter(data_dictionary), None)
+    accumulators = {}
+    for chunk in chunks:
+        fold_results(accumulators, evaluate_rules(chunk, rules, record_id))
+    return accumulated_results(accumulators, rules)
+
+# Columns that must be validated together, by field: a checkbox with its
+# exploded columns and any other columns named like its children (for the
+# unexpected_column rule); exploding fields with their exploded columns; every
+# other field on its own
+def field_groups(data_dictionary, columns):
+    groups = {field: [field] + info.get('exploded_fields', []) for field, info in data_dictionary.items()}
+    checkboxes = {field for field, info in data_dictionary.items() if info['type'] == 'checkbox'}
+    for column in columns:
+        parent = column.rsplit('_', 1)[0]
+        if parent in checkboxes and column not in data_dictionary and column not in groups[parent]:
+            groups[parent].append(column)
+    return groups
+
+# Split the fields into at most `shards` groups of similar column counts.
+# Largest groups are placed first, each on the currently smallest shard, so the
+# split only depends on the dictionary and the columns.
+def shard_fields(data_dictionary, columns, shards):
+    groups = field_groups(data_dictionary, columns)
+    buckets = [[] for _ in range(shards)]
+    sizes = [0] * shards
+    for field, group in sorted(groups.items(), key=lambda item: -len(item[1])):
+        i = sizes.index(min(sizes))
+        buckets[i].extend([field] + [col for col in group[1:] if col not in data_dictionary])
+        sizes[i] += len(group)
+    return [bucket for bucket in buckets if bucket]
+
+# Validate one shard in a worker process. The worker reads only its own columns
+# from disk, so no frame is pickled to it.
+def validate_shard(columns, data_dictionary, record_id, cohorts=None, chunksize=None):
+    if chunksize:
+        chunks, projected, _ = iter_combined(chunksize, columns=columns, cohorts=cohorts)
+        return validate_chunks(chunks, projected, data_dictionary, record_id)
+    df, _ = load_data(columns=columns, cohorts=cohorts, cache=False)
+    return validate(df, data_dictionary, record_id)
+
+# Process-parallel counterpart of validate for the combined dataset, over the
+# given dataset columns. Shard results are folded in rule table order, so the
+# output is the same as a single-process run whatever the worker count.
+def validate_parallel(data_dictionary, columns, workers, cohorts=None, chunksize=None, record_id=None):
+    rules = compile_rules(data_dictionary, columns)
+    record_id = record_id or next(iter(data_dictionary), None)
+    shards = shard_fields(data_dictionary, columns, workers)
+    accumulators = {}
+    # With profiling on, each shard's spans are sent back with its results
+    task = partial(profiling.collect, validate_shard) if profiling.enabled() else validate_shard
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(task, shard, {field: data_dictionary[field] for field in shard if field in data_dictionary},
+                        record_id, cohorts, chunksize)
+            for shard in shards
+        ]
+        for future in futures:
+            results = future.result()
+            if profiling.enabled():
+                results, spans = results
+                profiling.merge(spans)
+            fold_results(accumulators, results)
+    return accumulated_results(accumulators, rules)
+
+# Per-rule totals: failed columns and offending rows
+def summarize_results(results):
+    return results.groupby('rule').agg(columns=('column', 'size'), rows=('count', 'sum')).reset_index()
+
+# One line per result, grouped under the 02-validate.py section headings
+def format_results(results, data_dictionary):
+    sections = {}
+    for section, rules in SECTIONS.items():
+        lines = []
+        for row in results[results['rule'].isin(rules)].itertuples(index=False):
+            if row.rule == 'type':
+                lines.append(f"Column '{row.column}': Expected {row.expected}, got {row.values[0]}")
+            elif row.rule == 'value_range':
+                lines.append(f"Column '{row.column}': Invalid values found: {set(row.values)} ({row.count} rows)")
+            elif row.rule == 'checkbox_type':
+                lines.append(f"Exploded checkbox field '{row.column}' is not boolean type")
+            elif row.rule == 'unexpected_column':
+                lines.append(f"Checkbox field '{row.field}' has unexpected exploded field: {row.column}")
+        if section == 'Missing columns':
+            missing = results[results['rule'] == 'missing_column']
+            for field, group in missing.groupby('field', sort=False):
+                info = data_dictionary.get(field, {})
+                if info.get('exploding'):
+                    lines.append(f"Non-standard exploding field '{field}' is missing exploded fields: {group['column'].tolist()}")
+                elif info.get('is_checkbox'):
+                    lines.append(f"Checkbox field '{field}' is missing exploded fields: {group['column'].tolist()}")
+                else:
+                    lines.append(field)
+        sections[section] = lines
+    return sections
+
+# Write results as <base>.json and, with pyarrow, <base>.parquet
+def write_results(results, base):
+    summary = summarize_results(results)
+    with open(base + '.json', 'w', encoding='utf-8') as f:
+        json.dump({'summary': json.loads(summary.to_json(orient='records')),
+                   'results': json.loads(results.to_json(orient='records', default_handler=str))},
+                  f, indent=2)
+    if PARQUET:
+        # expected and values mix types between rules; store them as JSON text
+        table = results.assign(expected=results['expected'].map(lambda v: json.dumps(v, default=str)),
+                               values=results['values'].map(lambda v: json.dumps(v, default=str)),
+                               record_ids=results['record_ids'].map(lambda v: [str(i) for i in v]))
+        table.to_parquet(base + '.parquet', index=False)